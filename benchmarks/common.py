@@ -0,0 +1,82 @@
+"""Things shared by the benchmarks: loading the fixtures, answering
+search queries from them, and summarising timings.
+"""
+
+import glob
+import json
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+sys.path.insert(0, ROOT)
+
+
+def load_content_items():
+    """Load the recorded content items, as a dict from base path to raw
+    content item.
+    """
+
+    content_items = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURES, 'content', '*.json'))):
+        with open(path) as f:
+            raw = json.load(f)
+        content_items[raw['base_path']] = raw
+    return content_items
+
+
+def load_search():
+    """Load the recorded search documents and listings.
+    """
+
+    with open(os.path.join(FIXTURES, 'search.json')) as f:
+        return json.load(f)
+
+
+def search(fixtures, query, count=25, start=0):
+    """Answer a search query from the recorded search fixtures, in the
+    same shape as the GOV.UK search API.
+
+    Filtering by 'link' (with one value or a list) looks up documents;
+    any other filter gives a recorded listing.
+    """
+
+    if 'link' in query:
+        links = query['link'] if isinstance(query['link'], list) else [query['link']]
+        results = [doc for doc in fixtures['documents'] if doc['link'] in links]
+    else:
+        results = []
+        for field, value in query.items():
+            results.extend(fixtures['listings'].get(f'{field}={value}') or [])
+
+    return {
+        'results': results[start:start + count],
+        'start': start,
+        'total': len(results),
+    }
+
+
+def percentile(samples, p):
+    """Get the 'p'th percentile of some samples.
+    """
+
+    if samples == []:
+        return float('nan')
+    samples = sorted(samples)
+    i = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+    return samples[i]
+
+
+def report(name, samples, width=40):
+    """Print a line summarising some timings (in seconds).
+    """
+
+    total = sum(samples)
+    rate = len(samples) / total if total > 0 else float('inf')
+    print(
+        f'{name:<{width}} {rate:10.1f}/s'
+        f'  mean {total / len(samples) * 1000:8.3f}ms'
+        f'  p50 {percentile(samples, 50) * 1000:8.3f}ms'
+        f'  p99 {percentile(samples, 99) * 1000:8.3f}ms')
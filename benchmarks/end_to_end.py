@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""Benchmark the whole server: start the stub GOV.UK and server.py, and
+then send requests from some number of concurrent Gopher clients.
+
+Usage: python3 benchmarks/end_to_end.py [--clients N] [--requests N]
+           [--latency SECONDS] [--no-cache] [--workers N]
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import common
+
+
+def free_port():
+    """Find a port nothing is listening on.
+    """
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_port(port, timeout=10):
+    """Wait until something is listening on a port.
+    """
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+
+async def gopher_request(port, selector):
+    """Make a Gopher request, and return the response.
+    """
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'{selector}\r\n'.encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+async def run_clients(port, selectors, clients, requests):
+    """Send 'requests' requests, from 'clients' concurrent clients, and
+    return the latency of each and the number which failed.
+    """
+
+    samples = []
+    failures = 0
+    remaining = iter(range(requests))
+
+    async def client():
+        nonlocal failures
+        for i in remaining:
+            selector = selectors[i % len(selectors)]
+            start = time.perf_counter()
+            try:
+                response = await gopher_request(port, selector)
+                if response == b'':
+                    failures += 1
+            except OSError:
+                failures += 1
+            samples.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[client() for _ in range(clients)])
+    return samples, failures
+
+
+def main(clients, requests, latency, cache, workers):
+    stub_port = free_port()
+    server_port = free_port()
+
+    env = dict(os.environ)
+    env.update({
+        'IP': '127.0.0.1',
+        'PORT': str(server_port),
+        'GOVUK_URL': f'http://127.0.0.1:{stub_port}',
+        'WORKERS': str(workers),
+    })
+    if not cache:
+        env.update({
+            'CACHE_SIZE': '0',
+            'RENDER_CACHE_SIZE': '0',
+            'TEXT_CACHE_SIZE': '0',
+        })
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.join(here, 'stub_server.py'),
+             '--port', str(stub_port), '--latency', str(latency)]),
+        subprocess.Popen(
+            [sys.executable, os.path.join(common.ROOT, 'server.py')],
+            env=env, stdout=subprocess.DEVNULL),
+    ]
+
+    selectors = list(common.load_content_items())
+
+    async def go():
+        await wait_for_port(stub_port)
+        await wait_for_port(server_port)
+        start = time.perf_counter()
+        samples, failures = await run_clients(
+            server_port, selectors, clients, requests)
+        return samples, failures, time.perf_counter() - start
+
+    try:
+        samples, failures, elapsed = asyncio.run(go())
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    print(f'{requests} requests from {clients} clients, {workers} workers, upstream latency {latency * 1000:.0f}ms, caches {"on" if cache else "off"}')
+    print(f'  throughput {requests / elapsed:10.1f} requests/s')
+    print(f'  latency    p50 {common.percentile(samples, 50) * 1000:8.3f}ms'
+          f'  p99 {common.percentile(samples, 99) * 1000:8.3f}ms'
+          f'  max {max(samples) * 1000:8.3f}ms')
+    print(f'  failures   {failures}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument(
+        '--latency', type=float, default=0.05,
+        help='how long the stub GOV.UK takes to respond, in seconds')
+    parser.add_argument(
+        '--no-cache', dest='cache', action='store_false',
+        help='turn off the content, rendered menu, and text caches')
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    main(args.clients, args.requests, args.latency, args.cache, args.workers)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""Compare 'markup.text' against the original implementation, which
+made a new HTML2Text and post-processed each line separately with no
+caching.
+
+Usage: python3 benchmarks/markup_text.py [ITERATIONS]
+"""
+
+import sys
+import timeit
+
+import common  # noqa: F401
+
+import html2text  # noqa: E402
+import markup  # noqa: E402
+
+
+def original_text(html):
+    h = html2text.HTML2Text()
+    h.ignore_links = True
+    h.ignore_emphasis = True
+
+    lines = []
+    for line in h.handle(html).split('\n'):
+        if line[0:4] == '  *[':
+            continue
+        line = line.replace('‘', '\'').replace('’', '\'')
+        lines.append(line.rstrip())
+
+    return '\n'.join(lines).strip()
+
+
+def govspeak_fragment(parts=40):
+    """Make a long fragment of the sort of HTML govspeak produces.
+    """
+
+    html = []
+    for i in range(parts):
+        html.append(f'<h2 id="part-{i}">Part {i}: what you‘ll need</h2>')
+        html.append(
+            '<p>You can apply for <abbr title="Her Majesty’s Revenue and '
+            'Customs">HMRC</abbr> help if you’re eligible. Read the '
+            '<a href="/guidance">guidance</a> before you <strong>start'
+            '</strong>.</p>')
+        html.append(
+            '<ul><li>your National Insurance number</li>'
+            '<li>your bank details</li>'
+            '<li>details of any <em>other</em> income</li></ul>')
+        html.append(
+            '<div role="note" aria-label="Information" class="application-notice '
+            'info-notice"><p>You’ll need to reapply every year.</p></div>')
+    return ''.join(html)
+
+
+def main(iterations):
+    html = govspeak_fragment()
+
+    markup.configure_text_cache(max_entries=0)
+    assert markup.text(html).text == original_text(html)
+
+    original = timeit.timeit(lambda: original_text(html), number=iterations)
+    uncached = timeit.timeit(lambda: markup.text(html), number=iterations)
+
+    markup.configure_text_cache()
+    markup.text(html)
+    cached = timeit.timeit(lambda: markup.text(html), number=iterations)
+
+    print(f'fragment size: {len(html)} characters, {iterations} iterations')
+    for name, total in [
+            ('original', original),
+            ('markup.text (uncached)', uncached),
+            ('markup.text (cached)', cached)]:
+        per_call = total / iterations * 1000
+        print(f'{name:>24}: {per_call:8.3f} ms/call ({original / total:6.1f}x)')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""Benchmark parsing and rendering in isolation, over the recorded
+fixtures, with no I/O.
+
+Usage: python3 benchmarks/micro.py [--iterations N] [--text-cache]
+"""
+
+import argparse
+import time
+
+import common
+
+from govuk.content_schemas import UnknownDocumentType, parse_raw  # noqa: E402
+from markup import Elem  # noqa: E402
+import gopher  # noqa: E402
+import markup  # noqa: E402
+
+
+def time_calls(fn, args_list, iterations):
+    """Call 'fn' with each of 'args_list', 'iterations' times over, and
+    return the time each call took.
+    """
+
+    samples = []
+    for _ in range(iterations):
+        for args in args_list:
+            start = time.perf_counter()
+            fn(*args)
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def html_fragments(raw):
+    """Find the HTML fragments in a raw content item.
+    """
+
+    details = raw.get('details') or {}
+    fragments = []
+    for key in ['body', 'introductory_paragraph', 'more_information', 'other_ways_to_apply']:
+        if isinstance(details.get(key), str):
+            fragments.append(details[key])
+    for part in details.get('parts') or []:
+        fragments.append(part['body'])
+    return fragments
+
+
+def main(iterations, text_cache):
+    content_items = common.load_content_items()
+    search_fixtures = common.load_search()
+
+    def search(query, count=25, start=0):
+        return common.search(search_fixtures, query, count=count, start=start)
+
+    if not text_cache:
+        markup.configure_text_cache(max_entries=0)
+
+    parsed = {}
+    for base_path, raw in content_items.items():
+        try:
+            parsed[base_path] = parse_raw(raw, search)
+        except UnknownDocumentType:
+            pass
+
+    print(f'{iterations} iterations, text cache {"on" if text_cache else "off"}')
+    print()
+
+    print('parse_raw:')
+    for base_path in parsed:
+        raw = content_items[base_path]
+        common.report(
+            f'  {raw["document_type"]} {base_path}'[:60],
+            time_calls(parse_raw, [(raw, search)], iterations),
+            width=60)
+    print()
+
+    print('gopher.render:')
+    for base_path, content_item in parsed.items():
+        raw = content_items[base_path]
+        common.report(
+            f'  {raw["document_type"]} {base_path}'[:60],
+            time_calls(gopher.render, [('localhost', 70, content_item)], iterations),
+            width=60)
+    print()
+
+    lines = []
+    for content_item in parsed.values():
+        lines.append((content_item.description,))
+        for item in content_item.body:
+            if item.type is Elem.TEXT:
+                lines.extend((line,) for line in item.text.split('\n'))
+    fragments = [
+        (fragment,)
+        for raw in content_items.values()
+        for fragment in html_fragments(raw)
+    ]
+
+    print('text:')
+    common.report(
+        f'  gopher.wordwrap ({len(lines)} lines)',
+        time_calls(gopher.wordwrap, lines, iterations),
+        width=60)
+    common.report(
+        f'  markup.text ({len(fragments)} fragments)',
+        time_calls(markup.text, fragments, iterations),
+        width=60)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument(
+        '--text-cache', action='store_true',
+        help='cache HTML-to-text conversions, as the server does')
+    args = parser.parse_args()
+
+    main(args.iterations, args.text_cache)
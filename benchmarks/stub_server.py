@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""A stub of the GOV.UK content and search APIs, answering from the
+recorded fixtures.  Point the server at it with GOVUK_URL.
+
+Usage: python3 benchmarks/stub_server.py [--port PORT] [--latency SECONDS]
+           [--max-age SECONDS]
+"""
+
+from aiohttp import web
+import argparse
+import asyncio
+import hashlib
+import json
+
+import common
+
+
+def make_app(latency=0, max_age=None):
+    """Make the stub application.  Every response is delayed by
+    'latency' seconds, to stand in for the network.
+
+    Responses have an ETag, and conditional requests for unchanged
+    responses get a 304.  If 'max_age' is given, responses say they're
+    fresh for that long.
+    """
+
+    def respond(request, raw):
+        body = json.dumps(raw)
+        headers = {'ETag': '"' + hashlib.md5(body.encode()).hexdigest() + '"'}
+        if max_age is not None:
+            headers['Cache-Control'] = f'max-age={max_age}, public'
+        if request.headers.get('If-None-Match') == headers['ETag']:
+            return web.Response(status=304, headers=headers)
+        return web.Response(
+            text=body, content_type='application/json', headers=headers)
+
+    content_items = common.load_content_items()
+    search_fixtures = common.load_search()
+
+    async def content(request):
+        await asyncio.sleep(latency)
+        base_path = '/' + request.match_info['base_path'].strip('/')
+        raw = content_items.get(base_path)
+        if raw is None:
+            return web.json_response(
+                {'error': {'code': 404, 'message': 'Not found'}}, status=404)
+        return respond(request, raw)
+
+    async def search(request):
+        await asyncio.sleep(latency)
+        query = {}
+        for key in request.query.keys():
+            if not key.startswith('filter_'):
+                continue
+            if key.endswith('[]'):
+                query[key[len('filter_'):-2]] = request.query.getall(key)
+            else:
+                query[key[len('filter_'):]] = request.query[key]
+        count = int(request.query.get('count', '10'))
+        start = int(request.query.get('start', '0'))
+        return respond(
+            request,
+            common.search(search_fixtures, query, count=count, start=start))
+
+    app = web.Application()
+    app.router.add_get('/api/content/{base_path:.*}', content)
+    app.router.add_get('/api/search.json', search)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8070)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--max-age', type=int, default=None)
+    args = parser.parse_args()
+
+    web.run_app(
+        make_app(latency=args.latency, max_age=args.max_age), host='127.0.0.1', port=args.port,
+        print=None)
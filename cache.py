@@ -0,0 +1,101 @@
+import collections
+import threading
+import time
+
+Entry = collections.namedtuple('Entry', ['value', 'fresh_until', 'stale_until'])
+
+
+class Cache:
+    """A bounded, thread-safe, in-memory cache with expiry and LRU
+    eviction.
+
+    An entry is fresh for 'ttl' seconds after it is stored.  It is
+    then stale for a further 'stale_ttl' seconds, during which it is
+    still returned (so the caller can serve it while fetching a new
+    value), after which it is dropped.
+
+    When the cache is full, the least recently used entry is evicted.
+    """
+
+    def __init__(self, max_entries=1024, ttl=300, stale_ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.peek(key) is not None
+
+    def peek(self, key):
+        """Like 'get', but doesn't count as a use of the entry (for
+        eviction or hit rate statistics).
+        """
+
+        entry = self._entries.get(key)
+        if entry is None or entry.stale_until <= time.monotonic():
+            return None
+        return (entry.value, entry.fresh_until > time.monotonic())
+
+    def get(self, key):
+        """Look up a key.
+
+        Returns a pair '(value, is_fresh)', or 'None' if the key is not
+        present or has fully expired.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.stale_until <= now:
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return (entry.value, entry.fresh_until > now)
+
+    def set(self, key, value, ttl=None):
+        """Store a value, evicting the least recently used entries if
+        the cache is full.
+        """
+
+        if self.max_entries <= 0:
+            return
+
+        if ttl is None:
+            ttl = self.ttl
+
+        now = time.monotonic()
+        entry = Entry(
+            value=value,
+            fresh_until=now + ttl,
+            stale_until=now + ttl + self.stale_ttl,
+        )
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove a key, if present.
+        """
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove everything.
+        """
+
+        with self._lock:
+            self._entries.clear()
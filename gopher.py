@@ -1,5 +1,8 @@
 from markup import Elem
 
+# How many bytes of a long piece of text to render at once.
+TEXT_PIECE_SIZE = 16384
+
 
 class BadMarkup(Exception):
     pass
@@ -36,106 +39,145 @@ def bad_request_message(request):
     )
 
 
+def not_found_message(base_path):
+    """Return an error message when there's no such page on GOV.UK.
+    """
+
+    return generic_error(
+        f'Could not find "{base_path}"',
+        'There is no page at this path on GOV.UK.',
+    )
+
+
+def busy_message(base_path):
+    """Return an error message when GOV.UK can't be asked for a page
+    right now.
+    """
+
+    return generic_error(
+        f'Could not fetch "{base_path}"',
+        'The server is busy, try again in a moment.',
+    )
+
+
+def timeout_message(base_path):
+    """Return an error message when GOV.UK took too long to answer.
+    """
+
+    return generic_error(
+        f'Could not fetch "{base_path}"',
+        'GOV.UK took too long to answer, try again in a moment.',
+    )
+
+
+def overloaded_message():
+    """Return an error message when there are too many connections to
+    handle another.
+    """
+
+    return generic_error(
+        'Too many connections',
+        'The server is busy, try again in a moment.',
+    )
+
+
 def wordwrap(string, colwidth=80):
     """Wrap some text by breaking lines at spaces.
+
+    Each line is joined from its words once, rather than built up a
+    word at a time.
     """
 
     if string[0:4] == '  * ':
-        string = string[4:]
+        words = string[4:].split()
         islist = True
         colwidth = colwidth - 4
     else:
+        words = string.split()
         islist = False
 
+    if words == []:
+        return ['']
+
     out = []
-    line = ''
-    for word in string.split():
-        if line == '':
-            line = word
-            continue
-        if len(line) + len(word) + 1 > colwidth:
-            out.append(line)
-            line = word
+    start = 0
+    width = len(words[0])
+    for i in range(1, len(words)):
+        word_width = len(words[i])
+        if width + word_width + 1 > colwidth:
+            out.append(' '.join(words[start:i]))
+            start = i
+            width = word_width
         else:
-            line = f'{line} {word}'
-    if line != '':
-        out.append(line)
+            width += word_width + 1
+    out.append(' '.join(words[start:]))
 
     if islist:
-        for i in range(len(out)):
-            if i == 0:
-                out[i] = f'  * {out[i]}'
-            else:
-                out[i] = f'    {out[i]}'
-
-    if out == []:
-        out = ['']
+        out[0] = f'  * {out[0]}'
+        for i in range(1, len(out)):
+            out[i] = f'    {out[i]}'
 
     return out
 
 
-def render(host, port, content_item, colwidth=79):
-    """Render a content item as a gopher menu.
+def info_lines(lines):
+    """Encode some lines of text as info lines.
     """
 
-    sections = content_item_to_sections(
-        host, port, content_item, colwidth=colwidth)
-    return sections_to_menu(sections, colwidth=colwidth)
+    return ('i' + '\r\ni'.join(lines) + '\r\n').encode()
 
 
-def content_item_to_sections(host, port, content_item, colwidth=79):
-    """Turn a content item into a list of sections.
+def render(host, port, content_item, colwidth=79, search_selector=None):
+    """Render a content item as a gopher menu, as bytes.
     """
 
-    sections = []
+    buf = bytearray()
+    for piece in render_iter(
+            host, port, content_item, colwidth=colwidth,
+            search_selector=search_selector):
+        buf += piece
+    return bytes(buf)
+
+
+def render_iter(host, port, content_item, colwidth=79, search_selector=None):
+    """Render a content item as a gopher menu, a piece of bytes at a
+    time, so the start of the menu can be sent before the rest has been
+    rendered.
+    """
 
-    sections.append([[
-        f'i{content_item.title}\r\n',
-        f'i{content_item.updated_at}\r\n',
-    ]])
+    sections = iter_sections(
+        host, port, content_item, colwidth=colwidth,
+        search_selector=search_selector)
+    return iter_menu(sections, colwidth=colwidth)
+
+
+def iter_sections(host, port, content_item, colwidth=79, search_selector=None):
+    """Turn a content item into sections, lazily.  Each section is an
+    iterator of chunks, each chunk is bytes (or, for long text, an
+    iterator of pieces of bytes), and the body is only rendered as its
+    chunks are needed.
+
+    If 'search_selector' is given, there's a search box under the
+    description.
+    """
+
+    # the end of every link line to this server is the same
+    suffix = f'\t{host}\t{port}\r\n'.encode()
+
+    yield iter([info_lines([content_item.title, content_item.updated_at])])
 
     if content_item.description != '':
-        chunk = []
-        for line in wordwrap(content_item.description, colwidth=colwidth):
-            chunk.append(f'i{line}\r\n')
-        sections.append([chunk])
+        yield iter([info_lines(wordwrap(content_item.description, colwidth=colwidth))])
 
-    chunks = []
-    linklist = []
-    for item in content_item.body:
-        if linklist != [] and item['type'] not in [Elem.LINK, Elem.WEB_LINK]:
-            chunks.append(linklist)
-            linklist = []
-
-        if item['type'] == Elem.HEADING:
-            chunks.append([f'i# {item["text"]}\r\n'])
-        elif item['type'] == Elem.TEXT:
-            chunk = []
-            for line in item['text'].split('\n'):
-                for lline in wordwrap(line, colwidth=colwidth):
-                    chunk.append(f'i{lline}\r\n')
-            chunks.append(chunk)
-        elif item['type'] == Elem.LINK:
-            linklist.append(
-                f'1{item["text"]}\t{item["target"]}\t{host}\t{port}\r\n')
-        elif item['type'] == Elem.WEB_LINK:
-            linklist.append(
-                f'h{item["text"]} (HTTP link)\tURL:{item["target"]}\t\t\r\n')
-        else:
-            raise BadMarkup(item['type'])
-    if linklist != []:
-        chunks.append(linklist)
-    sections.append(chunks)
+    if search_selector is not None:
+        yield iter([f'7Search pages\t{search_selector}'.encode() + suffix])
+
+    yield iter_body_chunks(suffix, content_item.body, colwidth=colwidth)
 
     chunks = []
 
     def do_links(title, links):
-        render_links_as_chunk(
-            title,
-            links,
-            host,
-            port,
-            chunks)
+        render_links_as_chunk(title, links, suffix, chunks)
 
     if content_item.links.parent is not None:
         do_links('Parent', [content_item.links.parent])
@@ -143,50 +185,137 @@ def content_item_to_sections(host, port, content_item, colwidth=79):
     do_links('Related people', content_item.links.people)
     do_links('Related organisations', content_item.links.organisations)
     do_links('Related items', content_item.links.related_items)
-    sections.append(chunks)
+    yield iter(chunks)
+
+
+def iter_body_chunks(suffix, body, colwidth=79):
+    """Turn the body of a content item into chunks, lazily.  'suffix' is
+    the encoded end of a link line to this server.
+    """
+
+    linklist = None
+    for kind, text, target in body:
+        if linklist is not None and kind is not Elem.LINK and kind is not Elem.WEB_LINK:
+            yield bytes(linklist)
+            linklist = None
+
+        if kind is Elem.HEADING:
+            yield f'i# {text}\r\n'.encode()
+        elif kind is Elem.TEXT:
+            yield iter_text_pieces(text, colwidth=colwidth)
+        elif kind is Elem.LINK:
+            if linklist is None:
+                linklist = bytearray()
+            linklist += f'1{text}\t{target}'.encode()
+            linklist += suffix
+        elif kind is Elem.WEB_LINK:
+            if linklist is None:
+                linklist = bytearray()
+            linklist += f'h{text} (HTTP link)\tURL:{target}\t\t\r\n'.encode()
+        else:
+            raise BadMarkup(kind)
+    if linklist is not None:
+        yield bytes(linklist)
+
+
+def iter_text_pieces(text, colwidth=79):
+    """Turn some text into info lines, lazily, about 'TEXT_PIECE_SIZE'
+    bytes at a time, so a long publication isn't wrapped all at once.
+    """
 
-    return sections
+    lines = []
+    size = 0
+    for line in text.split('\n'):
+        for wrapped in wordwrap(line, colwidth=colwidth):
+            lines.append(wrapped)
+            size += len(wrapped) + 3
+            if size >= TEXT_PIECE_SIZE:
+                yield info_lines(lines)
+                lines = []
+                size = 0
+    if lines != []:
+        yield info_lines(lines)
 
 
 def sections_to_menu(sections, colwidth=79):
-    """Turn a list of sections into a Gopher menu.
+    """Turn a list of sections into a Gopher menu, as bytes.
     """
 
-    section_divider = [
-        'i\r\n',
-        'i' + ('-' * colwidth) + '\r\n',
-        'i\r\n',
-    ]
+    return b''.join(iter_menu(sections, colwidth=colwidth))
+
+
+def iter_menu(sections, colwidth=79):
+    """Turn sections into a Gopher menu, lazily.  This yields each chunk
+    (or each piece of a chunk), and the dividers between them, as bytes.
+    """
 
-    chunk_divider = ['i\r\n']
+    section_divider = (
+        'i\r\n'
+        'i' + ('-' * colwidth) + '\r\n'
+        'i\r\n'
+    ).encode()
 
-    menu = []
+    chunk_divider = b'i\r\n'
 
     first_section = True
     for section in sections:
-        if not first_section:
-            menu.extend(section_divider)
+        divider = b'' if first_section else section_divider
         first_chunk = True
         for chunk in section:
             if not first_chunk:
-                menu.extend(chunk_divider)
-            menu.extend(chunk)
+                divider = chunk_divider
+            if divider != b'':
+                yield divider
+            if isinstance(chunk, bytes):
+                yield chunk
+            else:
+                yield from chunk
+            divider = b''
             first_chunk = False
+        if divider != b'':
+            yield divider
         first_section = False
 
-    return ''.join(menu)
 
+def render_search_results(host, port, query, results, colwidth=79):
+    """Render search results as a gopher menu, as bytes.
+    """
+
+    suffix = f'\t{host}\t{port}\r\n'.encode()
+
+    if results == []:
+        summary = 'No pages found.'
+    elif len(results) == 1:
+        summary = '1 page found.'
+    else:
+        summary = f'{len(results)} pages found.'
+
+    chunks = []
+    for result in results:
+        chunk = bytearray(f'1{result.title}\t{result.base_path}'.encode())
+        chunk += suffix
+        if result.description != '':
+            chunk += info_lines(wordwrap(result.description, colwidth=colwidth))
+        chunks.append(bytes(chunk))
+
+    sections = [[info_lines([f'Search results for "{query}"', summary])]]
+    if chunks != []:
+        sections.append(chunks)
+    return sections_to_menu(sections, colwidth=colwidth)
 
-def render_links_as_chunk(title, links, host, port, chunks):
-    """Render some links as a chunk."""
+
+def render_links_as_chunk(title, links, suffix, chunks):
+    """Render some links as a chunk.  'suffix' is the encoded end of a
+    link line to this server.
+    """
 
     if links == []:
         return
 
-    chunk = []
+    chunk = bytearray()
     for link in links:
-        chunk.append(
-            f'1{link.title}\t{link.base_path}\t{host}\t{port}\r\n')
+        chunk += f'1{link.title}\t{link.base_path}'.encode()
+        chunk += suffix
 
-    chunks.append([f'i{title}:\r\n'])
-    chunks.append(chunk)
+    chunks.append(f'i{title}:\r\n'.encode())
+    chunks.append(bytes(chunk))
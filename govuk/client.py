@@ -0,0 +1,339 @@
+from collections import deque, namedtuple
+from govuk.ratelimit import Busy, acquire
+
+import aiohttp
+import asyncio
+import contextvars
+import json
+import metrics
+import random
+import re
+import time
+
+BASE_URL = 'https://www.gov.uk'
+
+LIMIT = 100
+
+KEEPALIVE_TIMEOUT = 30
+
+# How many seconds a request to GOV.UK can take, including retries, if
+# there is no deadline already.
+TIMEOUT = 10
+
+# How many times to retry a request which failed, and how long to wait
+# before the first retry (this doubles each time, with jitter).
+RETRIES = 2
+
+RETRY_BACKOFF = 0.1
+
+# Statuses which mean it's worth trying again.
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+# Whether to send a second copy of a request which is taking longer than
+# most, and use whichever answers first.
+HEDGE = False
+
+# How long to wait before hedging, until enough requests have been made
+# to know how long most take.
+HEDGE_DELAY = 0.5
+
+HEDGE_PERCENTILE = 95
+
+HEDGE_MIN_SAMPLES = 20
+
+# When the current request to GOV.UK has to be finished by, from
+# 'time.monotonic()', or 'None' for no deadline.
+DEADLINE = contextvars.ContextVar('deadline', default=None)
+
+_latencies = deque(maxlen=1000)
+
+# Responses at least this many bytes long are decoded in the default
+# executor, rather than holding up the event loop.
+DECODE_IN_EXECUTOR_SIZE = 65536
+
+_session = None
+
+MAX_AGE_PATTERN = re.compile(r'(?:^|[,\s])max-age=(\d+)')
+
+# What to send GOV.UK to ask whether a response has changed.
+Validators = namedtuple('Validators', ['etag', 'last_modified'])
+
+# A response from GOV.UK.  'raw' is 'None' if it hasn't changed since
+# the 'validators' sent with the request.  'max_age' is how many seconds
+# GOV.UK says the response is fresh for, or 'None' if it doesn't say.
+Response = namedtuple('Response', ['raw', 'validators', 'max_age'])
+
+
+class DeadlineExceeded(Exception):
+    """Raised when GOV.UK doesn't answer before the deadline.
+    """
+
+
+class NotFound(Exception):
+    """Raised when GOV.UK says there's nothing at a path.
+    """
+
+
+class UpstreamError(Exception):
+    """Raised when GOV.UK answers with an error (after retrying, if it's
+    a server error).  The arguments are the status and the path.
+    """
+
+
+class BadResponse(UpstreamError):
+    """Raised when GOV.UK answers with an empty response, or one which
+    isn't JSON.
+    """
+
+
+def configure(base_url='https://www.gov.uk', limit=100, keepalive_timeout=30,
+              timeout=10, retries=2, hedge=False):
+    """Set where GOV.UK is, the size of the upstream connection pool, and
+    how long idle connections are kept open.  The pool settings take
+    effect the next time a session is created.
+
+    Requests which fail are retried up to 'retries' times, as long as
+    they can finish within 'timeout' seconds (or the deadline, if
+    there is one).  If 'hedge' is true, requests which are slower than
+    most get a second copy sent.
+    """
+
+    global BASE_URL, LIMIT, KEEPALIVE_TIMEOUT, TIMEOUT, RETRIES, HEDGE
+    BASE_URL = base_url.rstrip('/')
+    LIMIT = limit
+    KEEPALIVE_TIMEOUT = keepalive_timeout
+    TIMEOUT = timeout
+    RETRIES = retries
+    HEDGE = hedge
+
+
+def set_deadline(seconds):
+    """Give every request to GOV.UK made from the current task (and tasks
+    it starts) 'seconds' from now to finish.  'None' removes the
+    deadline.
+    """
+
+    if seconds is None:
+        DEADLINE.set(None)
+    else:
+        DEADLINE.set(time.monotonic() + seconds)
+
+
+def session():
+    """Get the shared HTTP session, creating it if need be.
+
+    All requests to GOV.UK go through one session, so connections are
+    kept alive and reused.  There are at most 'LIMIT' connections open
+    at once: other requests wait for a free connection.
+    """
+
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=LIMIT,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+        )
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+async def close():
+    """Close the shared HTTP session, if there is one.
+    """
+
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+def max_age(cache_control):
+    """Get the 'max-age' from a Cache-Control header.  This is 'None' if
+    there isn't one, and 0 if the response mustn't be cached.
+    """
+
+    if cache_control is None:
+        return None
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return 0
+    match = MAX_AGE_PATTERN.search(cache_control)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+async def get_json(path, params=None, validators=None, api='other'):
+    """Make a GET request to GOV.UK and interpret the response as JSON.
+    Returns a 'Response'.  Large responses are decoded off the event
+    loop.  Every attempt is counted in the metrics, labelled with 'api'
+    and how it went.
+
+    If 'validators' are given, the request is conditional: if the
+    response hasn't changed, it isn't downloaded again, and 'raw' is
+    'None'.
+
+    Raises 'NotFound' if GOV.UK says there's nothing at the path,
+    'UpstreamError' if it answers with any other error, and
+    'BadResponse' if the response is empty or isn't JSON.  Requests
+    which fail, or get a server error, are retried after a random
+    delay.  If there's no answer before the deadline (see
+    'set_deadline'), or 'TIMEOUT' seconds if there isn't one, this
+    raises 'DeadlineExceeded'.
+
+    Requests are rate limited, so this may wait, or raise
+    'ratelimit.Busy'.
+    """
+
+    headers = {}
+    if validators is not None:
+        if validators.etag is not None:
+            headers['If-None-Match'] = validators.etag
+        if validators.last_modified is not None:
+            headers['If-Modified-Since'] = validators.last_modified
+
+    deadline = DEADLINE.get()
+    if deadline is None:
+        deadline = time.monotonic() + TIMEOUT
+
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded(path)
+        try:
+            return await asyncio.wait_for(
+                fetch_hedged(api, path, params, headers, validators, deadline),
+                remaining)
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(path)
+        except (aiohttp.ClientError, UpstreamError) as e:
+            if attempt >= RETRIES:
+                raise
+            if isinstance(e, UpstreamError) and e.args[0] not in RETRY_STATUSES:
+                raise
+            attempt += 1
+            metrics.UPSTREAM_RETRIES.inc((type(e).__name__,))
+            backoff = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+            await asyncio.sleep(min(backoff, max(0, deadline - time.monotonic())))
+
+
+def hedge_delay():
+    """Get how long to wait for a request before hedging it: longer than
+    'HEDGE_PERCENTILE' percent of recent requests have taken.
+    """
+
+    if len(_latencies) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DELAY
+    latencies = sorted(_latencies)
+    return latencies[min(len(latencies) - 1, len(latencies) * HEDGE_PERCENTILE // 100)]
+
+
+async def fetch_hedged(api, path, params, headers, validators, deadline):
+    """Make a request, and if hedging is on and it's slow, make it again
+    and use whichever answers first.
+    """
+
+    if not HEDGE:
+        return await fetch(api, path, params, headers, validators, deadline)
+
+    first = asyncio.ensure_future(
+        fetch(api, path, params, headers, validators, deadline))
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay())
+        if first not in done:
+            metrics.UPSTREAM_HEDGES.inc()
+            tasks.append(asyncio.ensure_future(
+                fetch(api, path, params, headers, validators, deadline)))
+
+        # use the first success, or the last failure
+        pending = tasks
+        while True:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+            if not pending:
+                return done.pop().result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def fetch(api, path, params, headers, validators, deadline):
+    """Make one request, decode the response, and count it.
+    """
+
+    try:
+        resp = await fetch_uncounted(path, params, headers, validators)
+    except BaseException as e:
+        metrics.UPSTREAM_REQUESTS.inc((api, attempt_result(e, deadline)))
+        raise
+    metrics.UPSTREAM_REQUESTS.inc(
+        (api, 'not_modified' if resp.raw is None else 'ok'))
+    return resp
+
+
+def attempt_result(error, deadline):
+    """Describe how a failed request went, for the metrics.
+    """
+
+    if isinstance(error, Busy):
+        return 'busy'
+    if isinstance(error, NotFound):
+        return 'not_found'
+    if isinstance(error, BadResponse):
+        return 'bad_response'
+    if isinstance(error, UpstreamError):
+        return 'server_error' if error.args[0] >= 500 else 'client_error'
+    if isinstance(error, aiohttp.ClientError):
+        return 'connection_error'
+    if isinstance(error, asyncio.CancelledError):
+        # cancelled by the deadline, or because a hedged copy won
+        return 'timeout' if time.monotonic() >= deadline else 'cancelled'
+    return 'error'
+
+
+async def fetch_uncounted(path, params, headers, validators):
+    """Make one request, and decode the response.
+    """
+
+    await acquire()
+    start = time.monotonic()
+    async with session().get(f'{BASE_URL}{path}', params=params, headers=headers) as resp:
+        if resp.status == 404:
+            raise NotFound(path)
+        if resp.status != 200 and not (resp.status == 304 and validators is not None):
+            raise UpstreamError(resp.status, path)
+        new_validators = Validators(
+            etag=resp.headers.get('ETag'),
+            last_modified=resp.headers.get('Last-Modified'),
+        )
+        cache_max_age = max_age(resp.headers.get('Cache-Control'))
+        if resp.status == 304:
+            _latencies.append(time.monotonic() - start)
+            # a 304 needn't repeat the validators
+            return Response(
+                raw=None,
+                validators=Validators(
+                    etag=new_validators.etag or validators.etag,
+                    last_modified=new_validators.last_modified or validators.last_modified,
+                ),
+                max_age=cache_max_age,
+            )
+        body = await resp.read()
+        _latencies.append(time.monotonic() - start)
+
+    if body.strip() == b'':
+        raise BadResponse(resp.status, path, 'empty response')
+    try:
+        if len(body) >= DECODE_IN_EXECUTOR_SIZE:
+            loop = asyncio.get_running_loop()
+            raw = await loop.run_in_executor(None, json.loads, body)
+        else:
+            raw = json.loads(body)
+    except ValueError as e:
+        raise BadResponse(resp.status, path, str(e))
+    return Response(raw=raw, validators=new_validators, max_age=cache_max_age)
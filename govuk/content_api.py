@@ -1,23 +1,272 @@
-from govuk.content_schemas import parse_raw
+from cache import Cache
+from govuk.client import DeadlineExceeded, NotFound, Response, get_json, set_deadline
+from govuk.content_schemas import (
+    MalformedContentItem, NoDocumentType, SearchNeeded, UnknownDocumentType,
+    parse_raw, prune_raw)
+from govuk.search_api import fetch_raw_search_results, query_key
+from singleflight import SingleFlight
 
-import requests
+import govuk.ratelimit as ratelimit
+import govuk.store as store
+import log
+import metrics
+import search_index
 
-API_PATH = 'https://www.gov.uk/api/content'
+import asyncio
+import time
 
+API_PATH = '/api/content'
 
-def fetch_raw_content_item(base_path):
+CACHE = Cache()
+
+# Pages which can't be shown, and why: the exception fetching or parsing
+# them raised.
+NEGATIVE_CACHE = Cache(ttl=60, stale_ttl=0)
+
+# The errors which will be the same if the page is fetched again soon.
+NEGATIVE_ERRORS = (
+    NotFound, NoDocumentType, UnknownDocumentType, MalformedContentItem)
+
+FLIGHTS = SingleFlight()
+
+metrics.register_cache('content', lambda: CACHE)
+metrics.register_cache('content_negative', lambda: NEGATIVE_CACHE)
+
+
+def configure_cache(max_entries=1024, ttl=300, stale_ttl=3600):
+    """Replace the content item cache.
+
+    Parsed content items are fresh for 'ttl' seconds, and can then be
+    served stale for a further 'stale_ttl' seconds while they are
+    refreshed in the background.  A 'max_entries' of 0 disables
+    caching.
+    """
+
+    global CACHE
+    CACHE = Cache(max_entries=max_entries, ttl=ttl, stale_ttl=stale_ttl)
+
+
+def configure_negative_cache(max_entries=1024, ttl=60):
+    """Replace the cache of pages which can't be shown.  Errors are
+    remembered for 'ttl' seconds.  A 'max_entries' of 0 disables
+    caching.
+    """
+
+    global NEGATIVE_CACHE
+    NEGATIVE_CACHE = Cache(max_entries=max_entries, ttl=ttl, stale_ttl=0)
+
+
+async def fetch_raw_content_item(base_path, use_store=True, validators=None):
     """Fetch a content item from the GOV.UK content API, and don't do any
-    validation or parsing beyond interpreting it as JSON.
+    validation or parsing beyond interpreting it as JSON.  Returns a
+    'client.Response'.
+
+    If 'use_store' is true and the content item is in the persistent
+    store, the stored copy is returned.  If the stored copy is old, the
+    content item is refreshed in the background.  Responses from GOV.UK
+    are always stored.
+
+    If 'validators' are given and GOV.UK says the content item hasn't
+    changed, 'raw' is 'None'.
+
+    Content items from GOV.UK are pruned down to what parsing needs
+    before they're stored.
+
+    In offline mode, only the store is used.
     """
 
-    resp = requests.get(f'{API_PATH}/{base_path}')
-    return resp.json()
+    if use_store or store.OFFLINE:
+        stored = await store.get('content', base_path)
+        if stored is not None:
+            if stored.age > store.MAX_AGE and not store.OFFLINE:
+                refresh_in_background(base_path)
+            return Response(stored.raw, stored.validators, None)
+        if store.OFFLINE:
+            raise store.NotStored(base_path)
 
+    start = time.perf_counter()
+    resp = await get_json(
+        f'{API_PATH}/{base_path}', validators=validators, api='content')
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - start, ('fetch',))
+    if resp.raw is None:
+        await store.touch('content', base_path, resp.validators)
+    else:
+        resp = resp._replace(raw=prune_raw(resp.raw))
+        await store.put('content', base_path, resp.raw, resp.validators)
+    return resp
 
-def fetch_content_item(base_path):
+
+async def fetch_content_item(base_path, page=1):
     """Fetch a content item from the GOV.UK content API, and parse the
-    JSON response if it's of a known type.
+    JSON response if it's of a known type.  For document types which
+    list search results, 'page' says which page of them to show.
+
+    Parsed content items are cached (each page separately), for as long
+    as GOV.UK says they're fresh for, if it says.  A stale cached item
+    is returned immediately, and refreshed in the background.
+
+    If the page recently couldn't be found, was of an unknown type, or
+    couldn't be parsed, the same error is raised again straight away.
+    """
+
+    error = NEGATIVE_CACHE.get(base_path)
+    if error is not None:
+        (error_type, args), _ = error
+        raise error_type(*args)
+
+    hit = CACHE.get((base_path, page))
+    if hit is not None:
+        (content_item, _), is_fresh = hit
+        if not is_fresh:
+            refresh_in_background(base_path, page)
+        return content_item
+
+    return await refresh_content_item(base_path, use_store=True, page=page)
+
+
+async def clamp_page(base_path, page):
+    """Get the page of a content item to show when 'page' is asked for:
+    pages past the last one (which is page 1, for document types which
+    aren't listings) get the last page instead, so there's only one
+    cache entry for each page which actually exists.
+
+    This fetches the first page, if it isn't cached.
     """
 
-    raw = fetch_raw_content_item(base_path)
-    return parse_raw(raw)
+    if page == 1:
+        return 1
+    first = await fetch_content_item(base_path)
+    return min(page, first.pages)
+
+
+async def refresh_content_item(base_path, use_store=False, page=1):
+    """Fetch and parse a content item, bypassing (but updating) the
+    cache.  If 'use_store' is true, a copy in the persistent store will
+    do.
+
+    If the content item is cached, GOV.UK is asked whether it has
+    changed, and if it hasn't, the cached item is kept (and becomes
+    fresh again) without being downloaded or parsed again.  Items which
+    list search results are always parsed again, as the results may
+    have changed even if the item hasn't.
+
+    Errors which will be the same if the page is fetched again soon are
+    remembered in 'NEGATIVE_CACHE'.
+
+    Concurrent refreshes of the same content item share one fetch and
+    parse.
+    """
+
+    key = (base_path, page)
+
+    async def go():
+        try:
+            return await fetch_and_parse()
+        except NEGATIVE_ERRORS as e:
+            NEGATIVE_CACHE.set(base_path, (type(e), e.args))
+            CACHE.delete(key)
+            if page == 1:
+                search_index.remove(base_path)
+            if isinstance(e, NotFound):
+                # or the stored copy is served once this is forgotten
+                await store.delete('content', base_path)
+            raise
+
+    async def fetch_and_parse():
+        cached = CACHE.peek(key)
+        validators = None
+        if cached is not None:
+            validators = cached[0][1]
+
+        resp = await fetch_raw_content_item(
+            base_path, use_store=use_store, validators=validators)
+        if resp.raw is None:
+            content_item = cached[0][0]
+        else:
+            content_item, searches = await parse_with_searches(
+                resp.raw, use_store=use_store, page=page)
+            if page == 1:
+                search_index.update(base_path, content_item)
+            if searches != {}:
+                resp = resp._replace(validators=None)
+            if use_store:
+                # a background refresh may have beaten us to it
+                hit = CACHE.peek(key)
+                if hit is not None and hit[1]:
+                    return hit[0][0]
+        CACHE.set(key, (content_item, resp.validators), ttl=resp.max_age)
+        return content_item
+
+    return await FLIGHTS.do((base_path, page, use_store), go)
+
+
+def refresh_in_background(base_path, page=1):
+    """Start refreshing a cached content item, unless it's already being
+    refreshed.
+    """
+
+    if (base_path, page, False) in FLIGHTS:
+        return
+
+    async def go():
+        # the refresh isn't held to the deadline of the request which
+        # started it
+        set_deadline(None)
+        try:
+            await refresh_content_item(base_path, page=page)
+        except (ratelimit.Busy, DeadlineExceeded):
+            # the stale copy will do until the next attempt
+            pass
+        except (NotFound, NoDocumentType, UnknownDocumentType):
+            # the page has gone, and this is remembered
+            pass
+        except Exception:
+            log.EVENTS.exception(f'Exception refreshing "{base_path}"')
+
+    asyncio.ensure_future(go())
+
+
+async def parse(raw, use_store=True, page=1):
+    """Parse a raw content item in the default executor, fetching any
+    search results it needs.  If 'use_store' is true, search results in
+    the persistent store will do.
+
+    Parsing is CPU-bound, so it's kept off the event loop.  When the
+    parser asks for search results we don't have, they're fetched and
+    parsing starts again.
+    """
+
+    content_item, _ = await parse_with_searches(
+        raw, use_store=use_store, page=page)
+    return content_item
+
+
+async def parse_with_searches(raw, use_store=True, page=1):
+    """Like 'parse', but also return the search results which were used,
+    keyed by query, count, and offset.
+    """
+
+    loop = asyncio.get_running_loop()
+    search_results = {}
+
+    def search(query, count=25, start=0):
+        key = (query_key(query), count, start)
+        if key not in search_results:
+            raise SearchNeeded(query, count, start)
+        return search_results[key]
+
+    elapsed = 0
+    while True:
+        start = time.perf_counter()
+        try:
+            content_item = await loop.run_in_executor(
+                None, parse_raw, raw, search, page)
+            metrics.STAGE_SECONDS.observe(
+                elapsed + time.perf_counter() - start, ('parse',))
+            return (content_item, search_results)
+        except SearchNeeded as e:
+            elapsed += time.perf_counter() - start
+            query, count, offset = e.args
+            search_results[(query_key(query), count, offset)] = \
+                await fetch_raw_search_results(
+                    query, count=count, start=offset, use_store=use_store)
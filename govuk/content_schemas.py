@@ -1,10 +1,16 @@
 import markup
+import math
 from collections import namedtuple
-from govuk.search_api import fetch_raw_search_results
 
+# How many search results to show on each page of a listing.
+PAGE_SIZE = 25
+
+# 'pages' is how many pages a listing of search results has, or 1 for
+# other document types.
 ContentItem = namedtuple(
     'ContentItem', [
-        'title', 'description', 'updated_at', 'body', 'links'])
+        'title', 'description', 'updated_at', 'body', 'links', 'pages'],
+    defaults=[1])
 
 Links = namedtuple('Links',
                    ['parent',
@@ -28,9 +34,140 @@ class MalformedContentItem(Exception):
     pass
 
 
-def parse_raw(raw):
+class Search:
+    """A search function, which remembers how many pages of results the
+    listing it was used for has.
+    """
+
+    def __init__(self, search):
+        self.search = search
+        self.pages = 1
+
+    def __call__(self, query, count=25, start=0):
+        return self.search(query, count=count, start=start)
+
+
+class SearchNeeded(Exception):
+    """Raised by a search function when it doesn't have the results for
+    a query yet.  The arguments are the query, the result count, and
+    the offset of the first result.
+    """
+
+
+# The top-level fields of a content item which parsing uses.
+FIELDS = [
+    'base_path',
+    'content_id',
+    'description',
+    'document_type',
+    'public_updated_at',
+    'title',
+]
+
+# The link groups which parsing uses, and the fields of each link.  The
+# content API expands links, so each link can carry its own links, and
+# those can be much larger than the content item itself.
+LINK_GROUPS = [
+    'children',
+    'mainstream_browse_pages',
+    'ministers',
+    'ordered_child_organisations',
+    'ordered_high_profile_groups',
+    'ordered_related_items',
+    'organisations',
+    'parent',
+    'parent_taxons',
+    'people',
+    'root_taxons',
+    'second_level_browse_pages',
+    'suggested_ordered_related_items',
+    'taxons',
+    'top_level_browse_pages',
+]
+
+LINK_FIELDS = ['title', 'base_path', 'content_id']
+
+# The details fields which each 'parse_details_*' function uses.
+DETAILS_FIELDS = {
+    'answer': ['body'],
+    'guide': ['parts'],
+    'html_publication': ['body'],
+    'mainstream_browse_page': ['groups', 'ordered_second_level_browse_pages'],
+    'news_story': ['body'],
+    'organisation': [
+        'body',
+        'foi_exempt',
+        'ordered_board_members',
+        'ordered_chief_professional_officers',
+        'ordered_corporate_information_pages',
+        'ordered_featured_documents',
+        'ordered_military_personnel',
+        'ordered_ministers',
+        'ordered_special_representatives',
+        'ordered_traffic_commissioners',
+    ],
+    'taxon': [],
+    'transaction': [
+        'introductory_paragraph',
+        'more_information',
+        'other_ways_to_apply',
+        'start_button_text',
+        'transaction_start_link',
+    ],
+}
+
+
+def prune_raw(raw):
+    """Drop the parts of a raw content item which parsing doesn't use, so
+    it's smaller to keep and to store.  Parsing a pruned content item
+    gives the same result as parsing the original.
+
+    If a parser starts using another field, it needs adding here.
+    """
+
+    if not isinstance(raw, dict):
+        return raw
+
+    pruned = {field: raw[field] for field in FIELDS if field in raw}
+
+    details = raw.get('details')
+    if isinstance(details, dict):
+        pruned['details'] = {
+            field: details[field]
+            for field in DETAILS_FIELDS.get(raw.get('document_type'), [])
+            if field in details
+        }
+
+    links = raw.get('links')
+    if isinstance(links, dict):
+        pruned['links'] = {
+            group: [
+                {field: link[field] for field in LINK_FIELDS if field in link}
+                if isinstance(link, dict) else link
+                for link in links[group]
+            ]
+            if isinstance(links[group], list) else links[group]
+            for group in LINK_GROUPS
+            if group in links
+        }
+
+    return pruned
+
+
+def parse_raw(raw, search, page=1):
     """Attempt to parse a raw content item.
 
+    Some document types need to query the search API.  Parsing doesn't
+    do any I/O itself, so 'search' is a function with the same arguments
+    as 'govuk.search_api.fetch_raw_search_results'.  If it raises
+    'SearchNeeded', parsing is abandoned so the caller can fetch the
+    results and try again.
+
+    Document types which list search results show one page of them:
+    'page' says which, counting from 1, and the content item says how
+    many pages there are.  Other document types ignore it, and have
+    one page.
+
     Throws:
 
     - 'NoDocumentType' if the 'document_type' field is missing
@@ -55,14 +192,18 @@ def parse_raw(raw):
     try:
         details = raw.get('details') or {}
         links = raw.get('links') or {}
-        body = globals()[document_type_parser](details, raw)
+        search = Search(search)
+        body = globals()[document_type_parser](details, raw, search, page)
         return ContentItem(
             title=raw['title'],
             description=raw.get('description') or '',
             updated_at=raw['public_updated_at'],
             body=body,
-            links=parse_links(links)
+            links=parse_links(links),
+            pages=search.pages,
         )
+    except SearchNeeded:
+        raise
     except Exception as e:
         raise MalformedContentItem(e)
 
@@ -132,7 +273,7 @@ def parse_links(links):
     )
 
 
-def parse_details_transaction(details, _content_item):
+def parse_details_transaction(details, _content_item, _search, _page):
     """Parse a transaction content item details hash."""
 
     body = []
@@ -156,37 +297,39 @@ def parse_details_transaction(details, _content_item):
     return body
 
 
-def parse_details_html_publication(details, _content_item):
+def parse_details_html_publication(details, _content_item, _search, _page):
     """Parse an html_publication content item details hash."""
 
     return [markup.text(details['body'])]
 
 
-def parse_details_answer(details, _content_item):
+def parse_details_answer(details, _content_item, _search, _page):
     """Parse an answer content item details hash."""
 
     return [markup.text(details['body'])]
 
 
-def parse_details_news_story(details, _content_item):
+def parse_details_news_story(details, _content_item, _search, _page):
     """Parse a news_story content item details hash."""
 
     return [markup.text(details['body'])]
 
 
-def parse_details_guide(details, _content_item):
+def parse_details_guide(details, _content_item, _search, _page):
     """Parse a guide content item details hash."""
 
-    body = []
+    parts = details['parts']
+    texts = markup.texts([part['body'] for part in parts])
 
-    for part in details['parts']:
+    body = []
+    for part, text in zip(parts, texts):
         body.append(markup.heading(part['title']))
-        body.append(markup.text(part['body']))
+        body.append(text)
 
     return body
 
 
-def parse_details_organisation(details, _content_item):
+def parse_details_organisation(details, _content_item, _search, _page):
     """Parse an organisation content item details hash."""
 
     body = []
@@ -246,7 +389,7 @@ def parse_details_organisation(details, _content_item):
     return body
 
 
-def parse_details_mainstream_browse_page(details, content_item):
+def parse_details_mainstream_browse_page(details, content_item, search, page):
     """Parse a mainstream_browse_page content item details hash.
 
     There are two types of mainstream browse page: "sections", which
@@ -290,8 +433,25 @@ def parse_details_mainstream_browse_page(details, content_item):
     all_links_by_base_path = {link['base_path']: link for link in all_links}
     all_links_by_content_id = {link['content_id']: link for link in all_links}
 
-    # Check for a curated list of children
-    for group in details.get('groups') or []:
+    # Check for a curated list of children.  The titles of any which
+    # aren't in the links hash are looked up in a single search.
+    groups = details.get('groups') or []
+
+    missing_base_paths = list(dict.fromkeys(
+        base_path
+        for group in groups
+        for base_path in group['contents']
+        if base_path not in all_links_by_base_path))
+
+    missing_titles_by_base_path = {}
+    if missing_base_paths != []:
+        for result in search(
+                {'link': missing_base_paths},
+                count=len(missing_base_paths)).get('results') or []:
+            missing_titles_by_base_path.setdefault(
+                result['link'], result['title'])
+
+    for group in groups:
         group_links = []
         for base_path in group['contents']:
             link = all_links_by_base_path.get(base_path)
@@ -300,16 +460,13 @@ def parse_details_mainstream_browse_page(details, content_item):
                     markup.link(
                         link['title'],
                         base_path))
-            else:
-                search = fetch_raw_search_results(
-                    {'link': base_path}).get('results') or []
-                if search != []:
-                    group_links.append(
-                        markup.link(
-                            search[0]['title'],
-                            base_path
-                        )
+            elif base_path in missing_titles_by_base_path:
+                group_links.append(
+                    markup.link(
+                        missing_titles_by_base_path[base_path],
+                        base_path
                     )
+                )
         if group_links != []:
             body.append(markup.heading(group['name']))
             body.extend(group_links)
@@ -319,9 +476,10 @@ def parse_details_mainstream_browse_page(details, content_item):
     # Check for a tagged list of children
     prefix = '/browse/'
     mbp_path = content_item['base_path'][len(prefix):]
-    for result in fetch_raw_search_results(
-            {'mainstream_browse_pages': mbp_path}).get('results') or []:
-        body.append(markup.link(result['title'], result['link']))
+    body = listing(
+        content_item['base_path'],
+        page,
+        search_page(search, {'mainstream_browse_pages': mbp_path}, page))
     if body != []:
         return body
 
@@ -347,7 +505,7 @@ def parse_details_mainstream_browse_page(details, content_item):
     return body
 
 
-def parse_details_taxon(details, content_item):
+def parse_details_taxon(details, content_item, search, page):
     """Parse a taxon content item details hash.
 
     Content is tagged to taxons, and is surfaced through search.  The
@@ -356,10 +514,52 @@ def parse_details_taxon(details, content_item):
     type.
     """
 
-    body = []
+    return listing(
+        content_item['base_path'],
+        page,
+        search_page(search, {'part_of_taxonomy_tree': content_item['content_id']}, page))
+
+
+def page_selector(base_path, page):
+    """Get the selector for a page of a listing.
+    """
+
+    if page == 1:
+        return base_path
+    return f'{base_path}?page={page}'
+
+
+def search_page(search, query, page):
+    """Get a page of search results, and remember how many pages there
+    are.
+    """
+
+    results = search(query, count=PAGE_SIZE, start=(page - 1) * PAGE_SIZE)
+    search.pages = max(1, math.ceil((results.get('total') or 0) / PAGE_SIZE))
+    return results
+
+
+def listing(base_path, page, results):
+    """Turn a page of search results into links, followed by links to the
+    pages either side if there is more than one page.
+    """
 
-    for result in fetch_raw_search_results(
-            {'part_of_taxonomy_tree': content_item['content_id']}).get('results') or []:
-        body.append(markup.link(result['title'], result['link']))
+    body = [
+        markup.link(result['title'], result['link'])
+        for result in results.get('results') or []
+    ]
+
+    pages = math.ceil((results.get('total') or 0) / PAGE_SIZE)
+    if page > pages and page > 1:
+        body.append(markup.heading('There are no more results'))
+        body.append(markup.link('First page', page_selector(base_path, 1)))
+    elif pages > 1:
+        body.append(markup.heading(f'Page {page} of {pages}'))
+        if page > 1:
+            body.append(markup.link(
+                'Previous page', page_selector(base_path, page - 1)))
+        if page < pages:
+            body.append(markup.link(
+                'Next page', page_selector(base_path, page + 1)))
 
     return body
@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+RATE = 0
+
+BURST = 10
+
+MAX_WAITING = 100
+
+# The time at which the bucket will next be full, if nothing else is
+# taken out.
+_full_at = 0
+
+_waiting = 0
+
+
+class Busy(Exception):
+    """Raised when a request to GOV.UK would have to wait, but too many
+    requests are already waiting.
+    """
+
+
+def configure(rate=0, burst=10, max_waiting=100):
+    """Limit requests to GOV.UK to 'rate' a second on average, in bursts
+    of up to 'burst'.
+
+    Requests over the limit wait their turn, unless 'max_waiting'
+    requests are already waiting, in which case they fail immediately
+    with 'Busy'.  A 'rate' of 0 disables rate limiting.
+    """
+
+    global RATE, BURST, MAX_WAITING, _full_at
+    RATE = rate
+    BURST = burst
+    MAX_WAITING = max_waiting
+    _full_at = 0
+
+
+async def acquire():
+    """Wait until a request to GOV.UK can be made.
+
+    This is a token bucket holding up to 'BURST' tokens, refilled at
+    'RATE' tokens a second.  Rather than counting tokens, it tracks when
+    the bucket would next be full: each request pushes that back by
+    one token's worth of time, and has to wait if that would put it
+    more than a full bucket's worth of time in the future.  Waiters are
+    served in the order they arrive.  A waiter which is cancelled gives
+    its token back.
+    """
+
+    global _full_at, _waiting
+
+    if RATE <= 0:
+        return
+
+    now = time.monotonic()
+    full_at = max(_full_at, now) + 1 / RATE
+    wait = full_at - now - BURST / RATE
+
+    if wait <= 0:
+        _full_at = full_at
+        return
+
+    if _waiting >= MAX_WAITING:
+        raise Busy()
+
+    _full_at = full_at
+    _waiting += 1
+    try:
+        await asyncio.sleep(wait)
+    except asyncio.CancelledError:
+        _full_at -= 1 / RATE
+        raise
+    finally:
+        _waiting -= 1
@@ -1,15 +1,121 @@
-import requests
+from govuk.client import DeadlineExceeded, get_json, set_deadline
+from singleflight import SingleFlight
 
-API_PATH = 'https://www.gov.uk/api/search.json'
+import asyncio
+import govuk.ratelimit as ratelimit
+import govuk.store as store
+import json
+import log
+import metrics
+import time
 
+API_PATH = '/api/search.json'
 
-def fetch_raw_search_results(query, count=25):
+FLIGHTS = SingleFlight()
+
+
+def query_key(query):
+    """Turn a search query into something hashable, so results can be
+    looked up by query.
+    """
+
+    return tuple(sorted(
+        (field, tuple(value) if isinstance(value, list) else value)
+        for (field, value) in query.items()))
+
+
+def search_key(query, count, start):
+    """Get the key a page of search results is stored under.  The first
+    page doesn't include the offset, so results stored before there
+    were other pages are still found.
+    """
+
+    if start == 0:
+        return (query_key(query), count)
+    return (query_key(query), count, start)
+
+
+async def fetch_raw_search_results(query, count=25, start=0, use_store=True):
     """Query the GOV.UK search API, and don't do any validation or parsing
     beyond interpreting it as JSON.
+
+    A filter value can be a list, to match any of several values.
+    'count' results are returned, skipping the first 'start'.
+
+    If 'use_store' is true and the results are in the persistent store,
+    the stored copy is returned.  If the stored copy is old, the query
+    is repeated in the background.  Responses from GOV.UK are always
+    stored.
+
+    In offline mode, only the store is used.
+
+    Concurrent identical queries share one request.
     """
 
-    payload = {f'filter_{field}': value for (field, value) in query.items()}
+    key = search_key(query, count, start)
+    store_key = json.dumps(key)
+
+    if use_store or store.OFFLINE:
+        stored = await store.get('search', store_key)
+        if stored is not None:
+            if stored.age > store.MAX_AGE and not store.OFFLINE:
+                refresh_in_background(query, count, start)
+            return stored.raw
+        if store.OFFLINE:
+            raise store.NotStored(query)
+
+    return await FLIGHTS.do(
+        key, fetch_and_store, query, count, start, store_key)
+
+
+def refresh_in_background(query, count, start=0):
+    """Start repeating a search query, unless it's already in flight.
+    """
+
+    if search_key(query, count, start) in FLIGHTS:
+        return
+
+    async def go():
+        set_deadline(None)
+        try:
+            await fetch_raw_search_results(
+                query, count=count, start=start, use_store=False)
+        except (ratelimit.Busy, DeadlineExceeded):
+            pass
+        except Exception:
+            log.EVENTS.exception(f'Exception refreshing search "{query}"')
+
+    asyncio.ensure_future(go())
+
+
+async def fetch_and_store(query, count, start, store_key):
+    """Query the GOV.UK search API, and store the response.
+
+    If the results are in the store, GOV.UK is asked whether they have
+    changed, and if they haven't, the stored copy is used.
+    """
+
+    stored = await store.get('search', store_key)
+    validators = None
+    if stored is not None:
+        validators = stored.validators
+
+    payload = {}
+    for (field, value) in query.items():
+        if isinstance(value, list):
+            payload[f'filter_{field}[]'] = value
+        else:
+            payload[f'filter_{field}'] = value
     payload['count'] = count
+    if start != 0:
+        payload['start'] = start
 
-    resp = requests.get(f'{API_PATH}', params=payload)
-    return resp.json()
+    fetch_start = time.perf_counter()
+    resp = await get_json(
+        f'{API_PATH}', params=payload, validators=validators, api='search')
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - fetch_start, ('fetch',))
+    if resp.raw is None:
+        await store.touch('search', store_key, resp.validators)
+        return stored.raw
+    await store.put('search', store_key, resp.raw, resp.validators)
+    return resp.raw
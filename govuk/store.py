@@ -0,0 +1,173 @@
+from collections import namedtuple
+from govuk.client import Validators
+
+import asyncio
+import concurrent.futures
+import json
+import sqlite3
+import time
+
+MAX_AGE = 300
+
+OFFLINE = False
+
+_db = None
+
+# sqlite connections can't be used from several threads at once, so all
+# access goes through one worker thread.
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+# A stored response: 'age' is how many seconds ago it was fetched (or
+# last found to be unchanged), and 'validators' are what to send GOV.UK
+# to ask whether it has changed since, or 'None'.
+Stored = namedtuple('Stored', ['raw', 'age', 'validators'])
+
+
+class NotStored(Exception):
+    """Raised in offline mode when something isn't in the store.
+    """
+
+
+def configure(path, max_age=300, offline=False):
+    """Open (creating if need be) a persistent store of raw responses from
+    GOV.UK.
+
+    Stored responses older than 'max_age' seconds are still used, but
+    are fetched again in the background.
+
+    If 'offline' is true, GOV.UK is never contacted: everything is
+    served from the store (for example, a mirror made by 'mirror.py'),
+    and anything which isn't there raises 'NotStored'.
+    """
+
+    global MAX_AGE, OFFLINE, _db
+
+    def go():
+        db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            '  kind TEXT NOT NULL,'
+            '  key TEXT NOT NULL,'
+            '  body TEXT NOT NULL,'
+            '  fetched_at REAL NOT NULL,'
+            '  validators TEXT,'
+            '  PRIMARY KEY (kind, key))')
+        columns = [row[1] for row in db.execute('PRAGMA table_info(responses)')]
+        if 'validators' not in columns:
+            db.execute('ALTER TABLE responses ADD COLUMN validators TEXT')
+        return db
+
+    MAX_AGE = max_age
+    OFFLINE = offline
+    _db = _executor.submit(go).result()
+
+
+async def get(kind, key):
+    """Look up a stored response.
+
+    Returns a 'Stored', or 'None' if there is no store or it's not
+    there.
+    """
+
+    if _db is None:
+        return None
+
+    # responses can be large, so they're decoded in the store's
+    # thread, not on the event loop
+    def go():
+        row = _db.execute(
+            'SELECT body, fetched_at, validators FROM responses '
+            'WHERE kind = ? AND key = ?',
+            (kind, key)).fetchone()
+        if row is None:
+            return None
+        body, fetched_at, validators = row
+        if validators is not None:
+            validators = Validators(*json.loads(validators))
+        return Stored(json.loads(body), time.time() - fetched_at, validators)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, go)
+
+
+async def items(kind):
+    """Get every stored response of a kind, as a list of '(key, raw)'
+    pairs, or '[]' if there is no store.
+    """
+
+    if _db is None:
+        return []
+
+    def go():
+        return [
+            (key, json.loads(body))
+            for key, body in _db.execute(
+                'SELECT key, body FROM responses WHERE kind = ?', (kind,))
+        ]
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, go)
+
+
+async def put(kind, key, raw, validators=None):
+    """Store a response, if there is a store.
+    """
+
+    if _db is None:
+        return
+
+    fetched_at = time.time()
+
+    def go():
+        body = json.dumps(raw)
+        encoded_validators = None
+        if validators is not None:
+            encoded_validators = json.dumps(validators)
+        _db.execute(
+            'INSERT OR REPLACE INTO responses '
+            '(kind, key, body, fetched_at, validators) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (kind, key, body, fetched_at, encoded_validators))
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, go)
+
+
+async def delete(kind, key):
+    """Remove a stored response, if there is a store.
+    """
+
+    if _db is None:
+        return
+
+    def go():
+        _db.execute(
+            'DELETE FROM responses WHERE kind = ? AND key = ?', (kind, key))
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, go)
+
+
+async def touch(kind, key, validators=None):
+    """Mark a stored response as fetched just now, as GOV.UK says it
+    hasn't changed.
+    """
+
+    if _db is None:
+        return
+
+    fetched_at = time.time()
+
+    def go():
+        encoded_validators = None
+        if validators is not None:
+            encoded_validators = json.dumps(validators)
+        _db.execute(
+            'UPDATE responses SET fetched_at = ?, validators = ? '
+            'WHERE kind = ? AND key = ?',
+            (fetched_at, encoded_validators, kind, key))
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, go)
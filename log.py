@@ -0,0 +1,138 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+
+# How many records can be waiting to be written before more are dropped.
+QUEUE_SIZE = 10000
+
+SLOW_THRESHOLD = 1.0
+
+# One JSON object per request.
+ACCESS = logging.getLogger('gopher.access')
+
+# The same, but only for requests which took at least 'SLOW_THRESHOLD'
+# seconds.
+SLOW = logging.getLogger('gopher.slow')
+
+# Everything else: startup, shutdown, and exceptions.
+EVENTS = logging.getLogger('gopher.events')
+
+_listener = None
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Pass records to the listener thread, dropping them if it's too far
+    behind rather than waiting.
+
+    Records whose message is a dict are formatted as JSON in the
+    listener thread, rather than here.
+    """
+
+    def __init__(self, queue, on_drop=None):
+        super().__init__(queue)
+        self.on_drop = on_drop
+
+    def prepare(self, record):
+        if isinstance(record.msg, dict):
+            return record
+        return super().prepare(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.on_drop is not None:
+                self.on_drop()
+
+
+class JSONFormatter(logging.Formatter):
+    """Format a record whose message is a dict as a line of JSON, with
+    the time added.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) +
+            f'.{int(record.msecs):03d}Z',
+        }
+        entry.update(record.msg)
+        return json.dumps(entry)
+
+
+def make_handler(destination, default_stream):
+    """Make a handler writing to a file, or to 'default_stream' if the
+    destination is '-'.
+    """
+
+    if destination == '-':
+        return logging.StreamHandler(default_stream)
+    return logging.FileHandler(destination)
+
+
+def configure(access_log='-', slow_log='-', slow_threshold=1.0, on_drop=None):
+    """Start logging.
+
+    Log records are put on a bounded queue, and written by a separate
+    thread, so a slow disk or pipe never holds up the event loop.  If
+    the queue is full, records are dropped, and 'on_drop' is called.
+
+    Access log entries are written to 'access_log', and requests taking
+    at least 'slow_threshold' seconds are also written to 'slow_log'.
+    Both can be a file name, '-' for standard output (access log) or
+    standard error (slow log), or '' to turn them off.  Everything else
+    goes to standard error.
+    """
+
+    global SLOW_THRESHOLD, _listener
+
+    stop()
+    SLOW_THRESHOLD = slow_threshold
+
+    log_queue = queue.Queue(QUEUE_SIZE)
+    handlers = []
+    for logger, destination, default_stream, formatter in [
+            (ACCESS, access_log, sys.stdout, JSONFormatter()),
+            (SLOW, slow_log, sys.stderr, JSONFormatter()),
+            (EVENTS, '-', sys.stderr, logging.Formatter('%(asctime)s %(levelname)s %(message)s'))]:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.propagate = False
+        if destination == '':
+            logger.disabled = True
+            continue
+        logger.disabled = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(QueueHandler(log_queue, on_drop=on_drop))
+
+        handler = make_handler(destination, default_stream)
+        handler.setFormatter(formatter)
+        handler.addFilter(logging.Filter(logger.name))
+        handlers.append(handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers)
+    _listener.start()
+
+
+def stop():
+    """Write out any waiting records, and stop the logging thread.
+    """
+
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def request(entry):
+    """Log a request, and log it as slow if it was.  'entry' is a dict,
+    including the time taken in 'seconds'.
+    """
+
+    ACCESS.info(entry)
+    if entry['seconds'] >= SLOW_THRESHOLD:
+        SLOW.warning(entry)
@@ -1,5 +1,31 @@
+from cache import Cache
+from collections import namedtuple
+import concurrent.futures
+import hashlib
 import html2text
 import enum
+import metrics
+import multiprocessing
+import os
+import threading
+
+TEXT_CACHE = Cache(max_entries=1024, ttl=float('inf'), stale_ttl=0)
+
+# Converting HTML holds the GIL, so HTML of at least this many
+# characters is converted in a pool of 'PROCESSES' processes, so a huge
+# page doesn't hold up every other request.  A 'PROCESSES' of 0
+# converts everything in the calling thread.
+PROCESS_THRESHOLD = 65536
+
+PROCESSES = os.cpu_count() or 1
+
+_pool = None
+
+_pool_lock = threading.Lock()
+
+metrics.register_cache('text', lambda: TEXT_CACHE)
+
+FANCY_QUOTES = str.maketrans({'‘': '\'', '’': '\''})
 
 
 class Elem(enum.Enum):
@@ -9,57 +35,152 @@ class Elem(enum.Enum):
     WEB_LINK = enum.auto()
 
 
+# An element of the body of a content item.  Content items are cached,
+# so there are a lot of these: a tuple is a lot smaller than a dict.
+# Headings and text don't have a 'target'.
+Element = namedtuple('Element', ['type', 'text', 'target'], defaults=[None])
+
+
 def heading(text):
     """Construct a section heading.
     """
 
-    return {
-        'type': Elem.HEADING,
-        'text': text
-    }
+    return Element(Elem.HEADING, text)
+
+
+def configure_text_cache(max_entries=1024):
+    """Replace the cache of converted HTML.  A 'max_entries' of 0
+    disables caching.
+    """
+
+    global TEXT_CACHE
+    TEXT_CACHE = Cache(max_entries=max_entries, ttl=float('inf'), stale_ttl=0)
+
+
+def configure_text_processes(processes=None, threshold=65536):
+    """Set how many processes convert large HTML, and how many
+    characters of HTML count as large.  A 'processes' of 0 converts
+    everything in the calling thread, and 'None' uses one per CPU.
+    """
+
+    global PROCESSES, PROCESS_THRESHOLD
+
+    close()
+    if processes is None:
+        processes = os.cpu_count() or 1
+    PROCESSES = processes
+    PROCESS_THRESHOLD = threshold
+
+
+def close(pool=None):
+    """Stop the processes converting large HTML, if they've started.  If
+    'pool' is given, they're only stopped if they're still that pool,
+    and not one which has replaced it.
+    """
+
+    global _pool
+    with _pool_lock:
+        if _pool is not None and (pool is None or _pool is pool):
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def pool():
+    """Get the pool of processes converting large HTML, starting it if
+    need be.
+    """
+
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # forking a process with threads running isn't safe
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PROCESSES,
+                mp_context=multiprocessing.get_context('spawn'))
+        return _pool
 
 
 def text(html):
     """Parse some HTML text.
+
+    Conversions are cached by a hash of the HTML, as the same fragments
+    get parsed again whenever a content item is refreshed.
+    """
+
+    return texts([html])[0]
+
+
+def texts(htmls):
+    """Parse several pieces of HTML text, returning them in the same
+    order.
+
+    Large pieces are converted in parallel in other processes, while
+    small pieces are converted in the calling thread.
+    """
+
+    keys = [
+        hashlib.blake2b(html.encode(), digest_size=16).digest()
+        for html in htmls
+    ]
+    converted = [None] * len(htmls)
+    futures = {}
+    executor = None
+
+    for i, html in enumerate(htmls):
+        hit = TEXT_CACHE.get(keys[i])
+        if hit is not None:
+            converted[i] = hit[0]
+        elif PROCESSES > 0 and len(html) >= PROCESS_THRESHOLD:
+            if executor is None:
+                executor = pool()
+            futures[i] = executor.submit(html_to_text, html)
+
+    for i, html in enumerate(htmls):
+        if converted[i] is None and i not in futures:
+            converted[i] = html_to_text(html)
+            TEXT_CACHE.set(keys[i], converted[i])
+
+    for i, future in futures.items():
+        try:
+            converted[i] = future.result()
+        except (concurrent.futures.BrokenExecutor,
+                concurrent.futures.CancelledError):
+            # a process died, or the pool was replaced: start a new
+            # pool next time
+            close(executor)
+            converted[i] = html_to_text(htmls[i])
+        TEXT_CACHE.set(keys[i], converted[i])
+
+    return [Element(Elem.TEXT, string) for string in converted]
+
+
+def html_to_text(html):
+    """Convert some HTML to plain text.
     """
 
     h = html2text.HTML2Text()
     h.ignore_links = True
     h.ignore_emphasis = True
 
-    lines = []
-    for line in h.handle(html).split('\n'):
-        # strip abbreviations, which can't be disabled...
-        if line[0:4] == '  *[':
-            continue
-        # replace fancy quotes
-        line = line.replace('‘', '\'').replace('’', '\'')
-        # strip trailing whitespace
-        lines.append(line.rstrip())
-
-    return {
-        'type': Elem.TEXT,
-        'text': '\n'.join(lines).strip(),
-    }
+    # replace fancy quotes, and strip trailing whitespace and
+    # abbreviations (which can't be disabled...)
+    lines = h.handle(html).translate(FANCY_QUOTES).split('\n')
+    return '\n'.join([
+        line.rstrip()
+        for line in lines
+        if line[0:4] != '  *['
+    ]).strip()
 
 
 def link(text, target):
     """Construct an internal link.
     """
 
-    return {
-        'type': Elem.LINK,
-        'text': text,
-        'target': target,
-    }
+    return Element(Elem.LINK, text, target)
 
 
 def web_link(text, target):
     """Construct an external link (to the web).
     """
 
-    return {
-        'type': Elem.WEB_LINK,
-        'text': text,
-        'target': target,
-    }
+    return Element(Elem.WEB_LINK, text, target)
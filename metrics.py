@@ -0,0 +1,188 @@
+import bisect
+import threading
+
+DEFAULT_BUCKETS = [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+_metrics = []
+
+_caches = {}
+
+# Which worker process this is, if there are several: every series gets
+# a "worker" label, so series from different workers can be told
+# apart.
+WORKER = None
+
+
+def set_worker(worker):
+    """Label every series with the worker process they're from.
+    """
+
+    global WORKER
+    WORKER = worker
+
+
+def format_labels(names, values, extra=''):
+    """Format label names and values as a Prometheus label set.
+    """
+
+    pairs = [f'{name}="{value}"' for (name, value) in zip(names, values)]
+    if WORKER is not None:
+        pairs.insert(0, f'worker="{WORKER}"')
+    if extra != '':
+        pairs.append(extra)
+    if pairs == []:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    """A count of something, split by zero or more labels.
+    """
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def exposition(self):
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} counter',
+        ]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(
+                    f'{self.name}{format_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    """A distribution of durations (in seconds), split by zero or more
+    labels.
+    """
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, label_values=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            observations = self._values.get(label_values)
+            if observations is None:
+                # one count per bucket, one for +Inf, then the sum
+                observations = [0] * (len(self.buckets) + 1) + [0.0]
+                self._values[label_values] = observations
+            observations[i] += 1
+            observations[-1] += value
+
+    def exposition(self):
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} histogram',
+        ]
+        with self._lock:
+            for label_values, observations in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ['+Inf'], observations):
+                    cumulative += count
+                    labels = format_labels(
+                        self.labels, label_values, f'le="{bound}"')
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = format_labels(self.labels, label_values)
+                lines.append(f'{self.name}_sum{labels} {observations[-1]}')
+                lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def register_cache(name, get_cache):
+    """Report the hits and misses of a 'cache.Cache'.  As caches can be
+    replaced when they're configured, 'get_cache' is a function which
+    returns the current one.
+    """
+
+    _caches[name] = get_cache
+
+
+def exposition():
+    """Render every metric in the Prometheus text format.
+    """
+
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.exposition())
+
+    lines.append('# HELP gopher_cache_lookups_total Cache lookups, by cache and result.')
+    lines.append('# TYPE gopher_cache_lookups_total counter')
+    for name, get_cache in sorted(_caches.items()):
+        cache = get_cache()
+        hit = format_labels(('cache', 'result'), (name, 'hit'))
+        miss = format_labels(('cache', 'result'), (name, 'miss'))
+        lines.append(f'gopher_cache_lookups_total{hit} {cache.hits}')
+        lines.append(f'gopher_cache_lookups_total{miss} {cache.misses}')
+
+    lines.append('# HELP gopher_cache_entries Entries in each cache.')
+    lines.append('# TYPE gopher_cache_entries gauge')
+    for name, get_cache in sorted(_caches.items()):
+        labels = format_labels(('cache',), (name,))
+        lines.append(f'gopher_cache_entries{labels} {len(get_cache())}')
+
+    return '\n'.join(lines) + '\n'
+
+
+REQUESTS = Counter(
+    'gopher_requests_total',
+    'Gopher requests handled.')
+
+CONNECTIONS_QUEUED = Counter(
+    'gopher_connections_queued_total',
+    'Connections which had to wait for others to finish before being handled.')
+
+CONNECTIONS_REJECTED = Counter(
+    'gopher_connections_rejected_total',
+    'Connections which were turned away because too many were open.')
+
+ERRORS = Counter(
+    'gopher_errors_total',
+    'Requests which were answered with an error, by exception type.',
+    labels=('type',))
+
+UPSTREAM_REQUESTS = Counter(
+    'gopher_upstream_requests_total',
+    'Requests made to GOV.UK (including retries and hedged copies), by API and result: "ok", "not_modified" (a conditional request found nothing had changed), "not_found", "bad_response" (empty or not JSON), "client_error", "server_error", "connection_error", "timeout", "cancelled" (a hedged copy answered first), "busy" (rate limited), or "error".',
+    labels=('api', 'result'))
+
+UPSTREAM_RETRIES = Counter(
+    'gopher_upstream_retries_total',
+    'Requests to GOV.UK which were retried, by what went wrong.',
+    labels=('error',))
+
+UPSTREAM_HEDGES = Counter(
+    'gopher_upstream_hedges_total',
+    'Requests to GOV.UK which were slow, so a second copy was sent.')
+
+STAGE_SECONDS = Histogram(
+    'gopher_stage_seconds',
+    'Time spent in each stage of handling a request: fetching from GOV.UK, parsing, rendering, and writing to the socket.',
+    labels=('stage',))
+
+REQUEST_SECONDS = Histogram(
+    'gopher_request_seconds',
+    'Time taken to handle a request, from reading the selector to closing the connection.')
+
+LOG_RECORDS_DROPPED = Counter(
+    'gopher_log_records_dropped_total',
+    'Log records dropped because they could not be written quickly enough.')
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+from govuk.search_api import fetch_raw_search_results
+import govuk.client as client
+import govuk.content_api as content_api
+import govuk.content_schemas as schemas
+import govuk.store as store
+import prefetch
+import search_index
+import asyncio
+import collections
+import datetime
+import os
+import sys
+import traceback
+
+# How many base paths to check for changes with one search query.
+BATCH_SIZE = 100
+
+
+def parse_timestamp(timestamp):
+    """Parse an ISO 8601 timestamp, or return 'None' if it can't be.
+    """
+
+    try:
+        return datetime.datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+
+
+async def changed_base_paths(base_paths):
+    """Work out which content items need fetching again.
+
+    An item needs fetching again if it isn't in the store, or if the
+    search API gives a different 'public_timestamp' to the stored
+    'public_updated_at'.  Items which the search API doesn't know about
+    are always fetched again.
+    """
+
+    changed = set()
+    stored_timestamps = {}
+    for base_path in base_paths:
+        stored = await store.get('content', base_path)
+        timestamp = None
+        if stored is not None:
+            timestamp = parse_timestamp(stored.raw.get('public_updated_at'))
+        if timestamp is None:
+            changed.add(base_path)
+        else:
+            stored_timestamps[base_path] = timestamp
+
+    if stored_timestamps == {}:
+        return changed
+
+    search_timestamps = {}
+    results = await fetch_raw_search_results(
+        {'link': list(stored_timestamps)},
+        count=len(stored_timestamps),
+        use_store=False,
+    )
+    for result in results.get('results') or []:
+        search_timestamps[result.get('link')] = parse_timestamp(
+            result.get('public_timestamp'))
+
+    for base_path, timestamp in stored_timestamps.items():
+        if search_timestamps.get(base_path) != timestamp:
+            changed.add(base_path)
+
+    return changed
+
+
+def has_next_page(content_item, base_path, page):
+    """Check if a content item links to the next page of a listing.
+    """
+
+    next_page = schemas.page_selector(base_path, page + 1)
+    return any(item.target == next_page for item in content_item.body)
+
+
+async def mirror_page(base_path, refetch):
+    """Fetch a page (and every page of any search results it lists) into
+    the store, unless it's unchanged, and return the base paths it
+    links to.
+    """
+
+    try:
+        resp = await content_api.fetch_raw_content_item(
+            base_path, use_store=not refetch)
+    except client.NotFound:
+        return []
+    try:
+        content_item = await content_api.parse(resp.raw, use_store=False)
+        await search_index.save(base_path, content_item)
+        links = prefetch.linked_base_paths(content_item)
+        page = 1
+        listing_base_path = resp.raw.get('base_path', base_path)
+        while has_next_page(content_item, listing_base_path, page):
+            page += 1
+            content_item = await content_api.parse(
+                resp.raw, use_store=False, page=page)
+            links.extend(prefetch.linked_base_paths(content_item))
+    except (schemas.NoDocumentType, schemas.UnknownDocumentType):
+        return []
+    return links
+
+
+async def crawl(start='/browse', limit=None, concurrency=8, full=False):
+    """Crawl GOV.UK into the store, starting from one page and following
+    every link.
+
+    Unless 'full' is true, content items already in the store are only
+    fetched again if they have changed.  Search results are always
+    fetched again, as listings change when other pages do.
+
+    Returns the number of pages crawled.
+    """
+
+    seen = {start}
+    queue = collections.deque([start])
+    crawled = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def go(base_path, refetch):
+        async with semaphore:
+            try:
+                return await mirror_page(base_path, refetch)
+            except Exception as e:
+                print(f'Exception mirroring "{base_path}": {str(e)}')
+                traceback.print_exc(file=sys.stdout)
+                return []
+
+    while queue:
+        batch = []
+        while queue and len(batch) < BATCH_SIZE:
+            if limit is not None and crawled + len(batch) >= limit:
+                break
+            batch.append(queue.popleft())
+        if batch == []:
+            break
+
+        if full:
+            changed = set(batch)
+        else:
+            changed = await changed_base_paths(batch)
+
+        all_links = await asyncio.gather(
+            *[go(base_path, base_path in changed) for base_path in batch])
+        crawled += len(batch)
+        print(f'Mirrored {crawled} pages ({len(changed)} of the last {len(batch)} fetched), {len(queue)} to go')
+
+        for links in all_links:
+            for base_path in links:
+                if base_path not in seen:
+                    seen.add(base_path)
+                    queue.append(base_path)
+
+    return crawled
+
+
+def run(path, start='/browse', limit=None, concurrency=8, full=False,
+        base_url='https://www.gov.uk'):
+    """Crawl GOV.UK into the store at 'path'.
+    """
+
+    store.configure(path, max_age=float('inf'))
+    client.configure(base_url=base_url, limit=concurrency)
+
+    async def go():
+        try:
+            return await crawl(
+                start=start, limit=limit, concurrency=concurrency, full=full)
+        finally:
+            await client.close()
+
+    crawled = asyncio.run(go())
+    print(f'Done: mirrored {crawled} pages')
+
+
+if __name__ == '__main__':
+    path = os.getenv('STORE_PATH')
+    if not path:
+        print('STORE_PATH must be set')
+        sys.exit(1)
+
+    limit = os.getenv('CRAWL_LIMIT')
+
+    run(
+        path,
+        start=os.getenv('CRAWL_START', '/browse'),
+        limit=int(limit) if limit else None,
+        concurrency=int(os.getenv('CRAWL_CONCURRENCY', '8')),
+        full=os.getenv('FULL', '') != '',
+        base_url=os.getenv('GOVUK_URL', 'https://www.gov.uk'),
+    )
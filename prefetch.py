@@ -0,0 +1,101 @@
+from markup import Elem
+import govuk.client as client
+import govuk.content_api as content_api
+import govuk.content_schemas as schemas
+import govuk.ratelimit as ratelimit
+import govuk.store as store
+import asyncio
+import log
+
+DEPTH = 0
+
+FANOUT = 10
+
+CONCURRENCY = 4
+
+_in_flight = set()
+
+
+def configure(depth=0, fanout=10, concurrency=4):
+    """Configure prefetching.
+
+    After a page is rendered, up to 'fanout' of the pages it links to
+    are fetched in the background, and then the pages they link to, and
+    so on, 'depth' links away.  At most 'concurrency' pages are
+    prefetched at once: if that many are already being prefetched,
+    further links are skipped.  A 'depth' of 0 disables prefetching.
+    """
+
+    global DEPTH, FANOUT, CONCURRENCY
+    DEPTH = depth
+    FANOUT = fanout
+    CONCURRENCY = concurrency
+
+
+def linked_base_paths(content_item):
+    """Get the base paths a content item links to, in the order they're
+    rendered, without duplicates.  Links to other pages of a listing
+    aren't included.
+    """
+
+    base_paths = [
+        item.target
+        for item in content_item.body
+        if item.type is Elem.LINK
+    ]
+
+    links = content_item.links
+    if links.parent is not None:
+        base_paths.append(links.parent.base_path)
+    for link in links.explore + links.people + links.organisations + links.related_items:
+        base_paths.append(link.base_path)
+
+    return list(dict.fromkeys(
+        base_path
+        for base_path in base_paths
+        if base_path[0:1] == '/' and '?' not in base_path))
+
+
+def prefetch(content_item, depth=None):
+    """Start fetching the pages a content item links to, if they're not
+    already cached.
+    """
+
+    if depth is None:
+        depth = DEPTH
+    if depth <= 0:
+        return
+
+    started = 0
+    for base_path in linked_base_paths(content_item):
+        if started >= FANOUT or len(_in_flight) >= CONCURRENCY:
+            return
+        if base_path in _in_flight or (base_path, 1) in content_api.CACHE:
+            continue
+
+        _in_flight.add(base_path)
+        asyncio.ensure_future(go(base_path, depth))
+        started += 1
+
+
+async def go(base_path, depth):
+    """Prefetch a page, and then the pages it links to.
+    """
+
+    # prefetching isn't held to the deadline of the request which
+    # started it
+    client.set_deadline(None)
+
+    try:
+        content_item = await content_api.fetch_content_item(base_path)
+    except (schemas.NoDocumentType, schemas.UnknownDocumentType,
+            store.NotStored, ratelimit.Busy, client.DeadlineExceeded,
+            client.NotFound):
+        return
+    except Exception:
+        log.EVENTS.exception(f'Exception prefetching "{base_path}"')
+        return
+    finally:
+        _in_flight.discard(base_path)
+
+    prefetch(content_item, depth=depth - 1)
@@ -0,0 +1,279 @@
+from collections import namedtuple
+from markup import Elem
+import govuk.store as store
+import asyncio
+import concurrent.futures
+import log
+import math
+import re
+import threading
+
+# How many updates can be waiting before more are skipped.
+MAX_PENDING = 1000
+
+# How much a word counts for, depending on where it is.
+TITLE_WEIGHT = 3
+HEADING_WEIGHT = 2
+DESCRIPTION_WEIGHT = 2
+TEXT_WEIGHT = 1
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+WORD_PATTERN = re.compile('[a-z0-9]+')
+
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has',
+    'have', 'how', 'if', 'in', 'is', 'it', 'of', 'on', 'or', 'that',
+    'the', 'this', 'to', 'was', 'what', 'when', 'which', 'who', 'will',
+    'with', 'you', 'your',
+])
+
+# A search result.
+Result = namedtuple('Result', ['base_path', 'title', 'description', 'score'])
+
+# An indexed page: 'weights' maps each word to how much it counts for.
+Document = namedtuple('Document', ['title', 'description', 'length', 'weights'])
+
+_pending = 0
+
+# Indexing is CPU-bound, so it's done in its own thread, one page at a
+# time.
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+def words(string):
+    """Split a string into lower-case words, without stop words.
+    """
+
+    return [
+        word
+        for word in WORD_PATTERN.findall(string.lower())
+        if word not in STOP_WORDS
+    ]
+
+
+def document(content_item):
+    """Work out how much each word of a page counts for.
+    """
+
+    weights = {}
+
+    def count(string, weight):
+        for word in words(string):
+            weights[word] = weights.get(word, 0) + weight
+
+    count(content_item.title, TITLE_WEIGHT)
+    count(content_item.description, DESCRIPTION_WEIGHT)
+    for item in content_item.body:
+        if item.type is Elem.HEADING:
+            count(item.text, HEADING_WEIGHT)
+        elif item.type is Elem.TEXT:
+            count(item.text, TEXT_WEIGHT)
+
+    return Document(
+        title=content_item.title,
+        description=content_item.description,
+        length=sum(weights.values()),
+        weights=weights,
+    )
+
+
+class Index:
+    """An inverted index of pages, searched with BM25.
+
+    Pages can be added and searched from different threads at once.
+    """
+
+    def __init__(self, max_documents=100000):
+        self.max_documents = max_documents
+        self._documents = {}
+        self._postings = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def add(self, base_path, document):
+        """Index a page's 'Document', replacing it if it's already
+        indexed.  Pages beyond 'max_documents' are ignored.
+        """
+
+        with self._lock:
+            if base_path not in self._documents and \
+                    len(self._documents) >= self.max_documents:
+                return
+            self._remove(base_path)
+            self._documents[base_path] = document
+            self._total_length += document.length
+            for word, weight in document.weights.items():
+                self._postings.setdefault(word, {})[base_path] = weight
+
+    def remove(self, base_path):
+        """Remove a page from the index, if it's there.
+        """
+
+        with self._lock:
+            self._remove(base_path)
+
+    def _remove(self, base_path):
+        document = self._documents.pop(base_path, None)
+        if document is None:
+            return
+        self._total_length -= document.length
+        for word in document.weights:
+            postings = self._postings[word]
+            del postings[base_path]
+            if postings == {}:
+                del self._postings[word]
+
+    def search(self, query, limit=50):
+        """Find the pages containing every word of a query, best first.
+        Returns a list of 'Result's.
+
+        The postings for the query are copied under the lock, and
+        scored outside it, so indexing isn't held up by searching.
+        """
+
+        query_words = list(dict.fromkeys(words(query)))
+        if query_words == []:
+            return []
+
+        with self._lock:
+            postings = [self._postings.get(word) for word in query_words]
+            if any(p is None for p in postings):
+                return []
+            postings = sorted((dict(p) for p in postings), key=len)
+            documents = {
+                base_path: self._documents[base_path]
+                for base_path in postings[0]
+            }
+            count = len(self._documents)
+            average_length = self._total_length / count
+
+        scores = {}
+        for base_path, document in documents.items():
+            if not all(base_path in p for p in postings[1:]):
+                continue
+            score = 0
+            for p in postings:
+                idf = math.log(1 + (count - len(p) + 0.5) / (len(p) + 0.5))
+                weight = p[base_path]
+                score += idf * weight * (K1 + 1) / (
+                    weight + K1 * (1 - B + B * document.length / average_length))
+            scores[base_path] = score
+
+        best = sorted(scores.items(), key=lambda kv: -kv[1])[:limit]
+        return [
+            Result(
+                base_path=base_path,
+                title=documents[base_path].title,
+                description=documents[base_path].description,
+                score=score,
+            )
+            for base_path, score in best
+        ]
+
+
+INDEX = Index()
+
+
+def configure(max_documents=100000):
+    """Replace the search index.  A 'max_documents' of 0 disables
+    indexing.
+    """
+
+    global INDEX
+    INDEX = Index(max_documents=max_documents)
+
+
+async def search(query, limit=50):
+    """Search the index in the default executor, so a query matching
+    a lot of pages doesn't hold up the event loop.
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, INDEX.search, query, limit)
+
+
+def update(base_path, content_item):
+    """Start indexing a page in the background, and keep what's indexed
+    in the persistent store.  If too many pages are waiting to be
+    indexed, this one is skipped.
+    """
+
+    global _pending
+
+    if INDEX.max_documents <= 0 or _pending >= MAX_PENDING:
+        return
+
+    def go():
+        doc = document(content_item)
+        INDEX.add(base_path, doc)
+        return doc
+
+    def done(future):
+        global _pending
+        _pending -= 1
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            log.EVENTS.error(
+                f'Exception indexing "{base_path}"', exc_info=future.exception())
+            return
+        asyncio.ensure_future(
+            store.put('index', base_path, future.result()._asdict()))
+
+    _pending += 1
+    loop = asyncio.get_running_loop()
+    loop.run_in_executor(_executor, go).add_done_callback(done)
+
+
+def remove(base_path):
+    """Remove a page from the index, and the persistent store's copy of
+    what's indexed.
+    """
+
+    INDEX.remove(base_path)
+    asyncio.ensure_future(store.delete('index', base_path))
+
+
+async def save(base_path, content_item):
+    """Work out what to index for a page, and keep it in the persistent
+    store, without indexing it here.  This is for 'mirror.py', so
+    servers using the mirror don't have to parse every page to index
+    it.
+    """
+
+    loop = asyncio.get_running_loop()
+    doc = await loop.run_in_executor(_executor, document, content_item)
+    await store.put('index', base_path, doc._asdict())
+
+
+async def index_store():
+    """Load the index kept in the persistent store, in the background.
+
+    Only what was worked out when the pages were fetched (or mirrored)
+    is loaded: pages aren't parsed again, so this doesn't compete with
+    serving requests for long.
+    """
+
+    if INDEX.max_documents <= 0:
+        return
+
+    documents = await store.items('index')
+    if documents == []:
+        return
+
+    def go():
+        for base_path, raw in documents:
+            if len(INDEX) >= INDEX.max_documents:
+                break
+            INDEX.add(base_path, Document(**raw))
+
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, go)
+
+    log.EVENTS.info(f'Indexed {len(INDEX)} pages from the store')
@@ -1,86 +1,616 @@
 #!/usr/bin/env python3
 
-from govuk.content_api import fetch_content_item
+from cache import Cache
+from govuk.content_api import (
+    configure_cache, configure_negative_cache, fetch_content_item, clamp_page)
+import govuk.client as client
 import govuk.content_schemas as schemas
+import govuk.ratelimit as ratelimit
+import govuk.store as store
+from singleflight import SingleFlight
 import gopher
+import log
+import markup
+import metrics
+import prefetch
+import search_index
 import asyncio
 import os
 import re
+import signal
 import sys
-import traceback
+import time
 
 BASE_PATH_PATTERN = re.compile('^(/[a-zA-Z0-9\-]+)+/?$')
 
+# Listings are split into pages, with selectors like "/path?page=2".
+PAGE_PATTERN = re.compile('^(.+)\\?page=([1-9][0-9]{0,5})$')
 
-def fetch_and_render(ip, port, request):
-    """Fetch a content item and render it, or an error, to a string.
+METRICS_SELECTOR = '/_metrics'
+
+SEARCH_SELECTOR = '/_search'
+
+COLWIDTH = 79
+
+# How many bytes of a menu to render before sending them.
+CHUNK_SIZE = 16384
+
+# How many seconds a client has to send its selector.
+READ_TIMEOUT = 10
+
+# The longest selector (with the query, for searches) which will be
+# read.
+MAX_SELECTOR_LENGTH = 4096
+
+# How many connections can be handled at once, and what to do with any
+# more: "queue" them until there's room, or reply to them with a "busy"
+# menu straight away.
+MAX_CONNECTIONS = 1000
+
+OVERFLOW = 'queue'
+
+# How many seconds a request can spend waiting for GOV.UK.
+REQUEST_TIMEOUT = 5
+
+# How many seconds to wait for requests to finish when shutting down.
+SHUTDOWN_TIMEOUT = 10
+
+RENDER_CACHE = Cache(ttl=86400, stale_ttl=0)
+
+FLIGHTS = SingleFlight()
+
+metrics.register_cache('render', lambda: RENDER_CACHE)
+
+_handlers = set()
+
+_slots = asyncio.Semaphore(MAX_CONNECTIONS)
+
+
+def configure_render_cache(max_entries=1024):
+    """Replace the rendered menu cache.  A 'max_entries' of 0 disables
+    caching.
+    """
+
+    global RENDER_CACHE
+    RENDER_CACHE = Cache(max_entries=max_entries, ttl=86400, stale_ttl=0)
+
+
+def configure_connections(max_connections=1000, overflow='queue', read_timeout=10):
+    """Set how many connections can be handled at once, what to do with
+    connections beyond that ("queue" or "busy"), and how many seconds a
+    client has to send its selector.  A 'max_connections' of 0 removes
+    the limit.
+    """
+
+    global MAX_CONNECTIONS, OVERFLOW, READ_TIMEOUT, _slots
+
+    if overflow not in ['queue', 'busy']:
+        raise ValueError(f'unknown overflow mode "{overflow}"')
+
+    MAX_CONNECTIONS = max_connections
+    OVERFLOW = overflow
+    READ_TIMEOUT = read_timeout
+    _slots = asyncio.Semaphore(max_connections) if max_connections > 0 else None
+
+
+def configure_request_timeout(timeout=5):
+    """Set how many seconds a request can spend waiting for GOV.UK,
+    across every request to GOV.UK it makes, before it gets an error.
+    """
+
+    global REQUEST_TIMEOUT
+    REQUEST_TIMEOUT = timeout
+
+
+class Rendering:
+    """A menu which is being rendered.
+
+    The menu is rendered a chunk at a time, as the fastest client
+    reading it needs more, and the chunks are kept so that other
+    clients reading it at the same time don't render them again.
+    Iterating over a rendering gives its chunks, as bytes.
+
+    When the last chunk is rendered, 'on_finish' is called with the
+    whole menu.
+    """
+
+    def __init__(self, pieces, on_finish=None):
+        self._pieces = pieces
+        self._chunks = []
+        self._finished = False
+        self._error = None
+        self._seconds = 0
+        self.on_finish = on_finish
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i < len(self._chunks):
+                yield self._chunks[i]
+                i += 1
+            elif self._error is not None:
+                raise self._error
+            elif self._finished:
+                return
+            else:
+                self._render_chunk()
+
+    def _render_chunk(self):
+        start = time.perf_counter()
+        buf = bytearray()
+        try:
+            for piece in self._pieces:
+                buf += piece
+                if len(buf) >= CHUNK_SIZE:
+                    break
+            else:
+                self._finished = True
+        except Exception as e:
+            self._error = e
+            raise
+
+        if buf:
+            self._chunks.append(bytes(buf))
+
+        self._seconds += time.perf_counter() - start
+        if self._finished:
+            metrics.STAGE_SECONDS.observe(self._seconds, ('render',))
+            if self.on_finish is not None:
+                self.on_finish(b''.join(self._chunks))
+
+
+def render(ip, port, base_path, page, content_item, colwidth=COLWIDTH):
+    """Render a content item, reusing an earlier rendering if there is
+    one.
+
+    Returns the menu as bytes if it has already been rendered, or a
+    'Rendering' which can be streamed to the client if not.
+
+    A rendering is only reused if it was made from this very content
+    item: when the content item cache refreshes an item, the old
+    rendering is discarded.
+    """
+
+    key = (base_path, page, ip, port, colwidth)
+    stale = RENDER_CACHE.peek(key)
+    if stale is not None and stale[0][0] is not content_item:
+        # rendered from an older copy of the item, so this is a miss
+        RENDER_CACHE.delete(key)
+    hit = RENDER_CACHE.get(key)
+    if hit is not None:
+        (_, response), _ = hit
+        return response
+
+    def on_finish(response):
+        # only replace this rendering, not a newer one
+        hit = RENDER_CACHE.peek(key)
+        if hit is not None and hit[0][1] is rendering:
+            RENDER_CACHE.set(key, (content_item, response))
+
+    search_selector = None
+    if base_path == '/browse' and search_index.INDEX.max_documents > 0:
+        search_selector = SEARCH_SELECTOR
+
+    rendering = Rendering(
+        gopher.render_iter(
+            ip, port, content_item, colwidth=colwidth,
+            search_selector=search_selector),
+        on_finish=on_finish,
+    )
+    RENDER_CACHE.set(key, (content_item, rendering))
+    return rendering
+
+
+async def fetch_page(base_path, page):
+    """Fetch a page of a content item.  Returns a pair '(page,
+    content_item)', as pages past the last one get the last one.
+
+    This can join a fetch started by something else (like a prefetch)
+    which isn't held to this request's deadline, so the wait for it is
+    cut short at the deadline, raising 'client.DeadlineExceeded'.  The
+    fetch itself carries on.
+    """
+
+    async def go():
+        clamped = await clamp_page(base_path, page)
+        return (clamped, await fetch_content_item(base_path, page=clamped))
+
+    try:
+        return await asyncio.wait_for(go(), REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise client.DeadlineExceeded(base_path)
+
+
+async def fetch_and_render(ip, port, request, colwidth=COLWIDTH):
+    """Fetch a content item and render it, or an error.  Returns a pair
+    '(status, response)', where the status is "ok" or what went wrong,
+    and the response is bytes or a 'Rendering'.
+
+    Concurrent identical requests share one fetch and render.
+    """
+
+    return await FLIGHTS.do(
+        (ip, port, request, colwidth),
+        fetch_and_render_uncoalesced, ip, port, request, colwidth)
+
+
+async def fetch_and_render_uncoalesced(ip, port, request, colwidth):
+    """Fetch a content item and render it, or an error.  Returns a pair
+    '(status, response)'.
     """
 
     if request in ['', '/']:
         request = '/browse'
 
-    if BASE_PATH_PATTERN.match(request):
+    if request == METRICS_SELECTOR:
+        return ('ok', metrics.exposition().encode())
+
+    # a search request is the selector, a tab, and the query
+    if request.split('\t')[0] == SEARCH_SELECTOR:
+        query = request[len(SEARCH_SELECTOR) + 1:]
+        results = await search_index.search(query)
+        return ('ok', gopher.render_search_results(
+            ip, port, query, results, colwidth=colwidth))
+
+    base_path = request
+    page = 1
+    match = PAGE_PATTERN.match(request)
+    if match is not None:
+        base_path = match.group(1)
+        page = int(match.group(2))
+
+    if BASE_PATH_PATTERN.match(base_path):
+        client.set_deadline(REQUEST_TIMEOUT)
         try:
-            content_item = fetch_content_item(request)
-            response = gopher.render(ip, port, content_item)
+            page, content_item = await fetch_page(base_path, page)
+            response = render(
+                ip, port, base_path, page, content_item, colwidth=colwidth)
+            prefetch.prefetch(content_item)
+            return ('ok', response)
         except schemas.UnknownDocumentType as e:
+            error = e
             response = gopher.bad_content_message(
                 request, f'This page is of type "{e.args[0]}", which is not supported.')
-        except schemas.NoDocumentType:
+        except schemas.NoDocumentType as e:
+            error = e
             response = gopher.bad_content_message(
                 request, 'Something went wrong parsing the response from GOV.UK.')
+        except client.NotFound as e:
+            error = e
+            response = gopher.not_found_message(request)
+        except ratelimit.Busy as e:
+            error = e
+            response = gopher.busy_message(request)
+        except client.DeadlineExceeded as e:
+            error = e
+            response = gopher.timeout_message(request)
+        except store.NotStored as e:
+            error = e
+            response = gopher.bad_content_message(
+                request, 'This page is not in the mirror.')
         except schemas.MalformedContentItem as e:
-            print(f'Exception: {str(e)}')
-            traceback.print_exc(file=sys.stdout)
+            error = e
+            log.EVENTS.exception(f'Exception parsing "{request}"')
             response = gopher.bad_content_message(
                 request, 'Something went wrong parsing the response from GOV.UK.')
         except Exception as e:
-            print(f'Exception: {str(e)}')
-            traceback.print_exc(file=sys.stdout)
+            error = e
+            log.EVENTS.exception(f'Exception handling "{request}"')
             response = gopher.bad_content_message(
                 request, 'Something went wrong.')
-        return response
+        status = type(error).__name__
+        metrics.ERRORS.inc((status,))
+        return (status, response.encode())
 
-    return gopher.bad_request_message(request)
+    return ('bad_request', gopher.bad_request_message(request).encode())
 
 
 async def handler(reader, writer):
-    raw = await reader.read(4096)
-    request = raw.decode().strip()
+    """Handle a connection, if there's room for it.
+
+    If 'MAX_CONNECTIONS' are already being handled, the connection
+    either waits for one of them to finish, or is sent a "busy" menu
+    and closed, depending on 'OVERFLOW'.
+    """
+
+    task = asyncio.current_task()
+    _handlers.add(task)
+    try:
+        slots = _slots
+        if slots is None:
+            await handle(reader, writer)
+            return
+
+        if slots.locked():
+            if OVERFLOW == 'busy':
+                metrics.CONNECTIONS_REJECTED.inc()
+                writer.write(gopher.overloaded_message().encode())
+                writer.close()
+                return
+            metrics.CONNECTIONS_QUEUED.inc()
+
+        async with slots:
+            await handle(reader, writer)
+    finally:
+        _handlers.discard(task)
+
+
+async def read_selector(reader):
+    """Read a selector, up to the CRLF which ends it (a client which
+    closes the connection after the selector needn't send one).
+
+    Raises 'asyncio.TimeoutError' if the client takes more than
+    'READ_TIMEOUT' seconds, and 'asyncio.LimitOverrunError' if the
+    selector is longer than 'MAX_SELECTOR_LENGTH'.
+    """
+
+    try:
+        raw = await asyncio.wait_for(reader.readuntil(b'\n'), READ_TIMEOUT)
+    except asyncio.IncompleteReadError as e:
+        raw = e.partial
+    return raw.rstrip(b'\r\n').decode(errors='replace')
+
+
+async def handle(reader, writer):
+    start = time.perf_counter()
     ip, port = writer.get_extra_info('sockname')
-    addr = writer.get_extra_info('peername')
-    print(f'{addr}: "{request}"')
+    peer = writer.get_extra_info('peername')
+    request = None
+    try:
+        request = await read_selector(reader)
+    except asyncio.TimeoutError:
+        status, response = 'read_timeout', b''
+    except asyncio.LimitOverrunError:
+        status, response = 'bad_request', gopher.bad_request_message(
+            'a very long selector').encode()
+    except ConnectionError as e:
+        status, response = type(e).__name__, b''
+    read_seconds = time.perf_counter() - start
 
-    loop = asyncio.get_event_loop()
-    response = await loop.run_in_executor(None, fetch_and_render, ip, port, request)
+    if request is not None:
+        status, response = await fetch_and_render(ip, port, request)
+    fetch_seconds = time.perf_counter() - start - read_seconds
 
-    writer.write(response.encode())
-    await writer.drain()
+    # a rendering renders as it's written, so time them separately
+    if isinstance(response, bytes):
+        chunks = iter([response])
+    else:
+        chunks = iter(response)
+    render_seconds = 0
+    write_seconds = 0
+    sent = 0
+    try:
+        while True:
+            render_start = time.perf_counter()
+            chunk = next(chunks, None)
+            write_start = time.perf_counter()
+            render_seconds += write_start - render_start
+            if chunk is None:
+                break
+            writer.write(chunk)
+            await writer.drain()
+            write_seconds += time.perf_counter() - write_start
+            sent += len(chunk)
+    except Exception as e:
+        status = type(e).__name__
+        log.EVENTS.exception(f'Exception sending "{request}"')
 
     writer.close()
 
+    seconds = time.perf_counter() - start
+    metrics.REQUESTS.inc()
+    metrics.STAGE_SECONDS.observe(write_seconds, ('write',))
+    metrics.REQUEST_SECONDS.observe(seconds)
+    log.request({
+        'peer': peer[0] if peer else None,
+        'selector': request,
+        'status': status,
+        'bytes': sent,
+        'seconds': round(seconds, 6),
+        'stages': {
+            'read': round(read_seconds, 6),
+            'fetch': round(fetch_seconds, 6),
+            'render': round(render_seconds, 6),
+            'write': round(write_seconds, 6),
+        },
+    })
+
 
-def run(ip='127.0.0.1', port=70):
-    """Serves gopher requests until C-c is hit.
+def run(ip='127.0.0.1', port=70, reuse_port=False):
+    """Serves gopher requests until C-c is hit or SIGTERM is received.
+
+    On shutdown, requests which are being handled get up to
+    'SHUTDOWN_TIMEOUT' seconds to finish.
     """
 
-    loop = asyncio.get_event_loop()
-    coro = asyncio.start_server(handler, ip, port, loop=loop)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    coro = asyncio.start_server(
+        handler, ip, port, reuse_port=reuse_port, limit=MAX_SELECTOR_LENGTH)
     server = loop.run_until_complete(coro)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    indexing = loop.create_task(search_index.index_store())
 
-    print('Gopher server running')
+    log.EVENTS.info(f'Gopher server running (pid {os.getpid()})')
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
 
+    indexing.cancel()
     server.close()
     loop.run_until_complete(server.wait_closed())
+    if _handlers:
+        loop.run_until_complete(
+            asyncio.wait(_handlers, timeout=SHUTDOWN_TIMEOUT))
+    loop.run_until_complete(client.close())
     loop.close()
+    markup.close()
+    log.stop()
+
+
+def run_workers(ip='127.0.0.1', port=70, workers=2, setup=None):
+    """Serves gopher requests from several worker processes until C-c is
+    hit or SIGTERM is received.
+
+    Each worker is a forked process running 'run', and they share the
+    port with SO_REUSEPORT, so the kernel spreads connections between
+    them.  'setup' is called in each worker before it starts serving.
+    Workers which die are restarted, and on shutdown each worker is
+    sent SIGTERM and waited for.
+
+    The supervisor only logs events (like a worker dying): requests
+    are logged by the workers.
+
+    Workers don't share caches or metrics, but they do share the
+    persistent store.  Each worker's metrics are labelled with its
+    number (which a restarted worker keeps), as any worker can answer a
+    request for them.
+    """
+
+    children = {}
+    stopping = False
+
+    def start_worker(worker):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            metrics.set_worker(worker)
+            # the supervisor's logging thread doesn't exist in the
+            # worker, so start the worker's own ('setup' can replace it)
+            log.configure(access_log='', slow_log='')
+            status = 0
+            try:
+                if setup is not None:
+                    setup()
+                run(ip=ip, port=port, reuse_port=True)
+            except BaseException:
+                log.EVENTS.exception(f'Worker {os.getpid()} crashed')
+                status = 1
+            finally:
+                # os._exit doesn't run the atexit handlers which would
+                # write out waiting log records
+                log.stop()
+                sys.stdout.flush()
+                os._exit(status)
+        children[pid] = (worker, time.monotonic())
+
+    def stop(_signum, _frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    log.configure(access_log='', slow_log='')
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for worker in range(workers):
+        start_worker(worker)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        child = children.pop(pid, None)
+        if child is None or stopping:
+            continue
+        worker, started = child
+        log.EVENTS.warning(f'Worker {pid} died (status {status}), restarting')
+        # don't restart a worker which is crashing on startup in a
+        # tight loop
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+        start_worker(worker)
+
+    log.stop()
+
+
+def configure_from_environment():
+    """Configure everything from environment variables.
+    """
+
+    log.configure(
+        access_log=os.getenv('ACCESS_LOG', '-'),
+        slow_log=os.getenv('SLOW_LOG', '-'),
+        slow_threshold=float(os.getenv('SLOW_REQUEST_THRESHOLD', '1')),
+        on_drop=metrics.LOG_RECORDS_DROPPED.inc,
+    )
+    client.configure(
+        base_url=os.getenv('GOVUK_URL', 'https://www.gov.uk'),
+        limit=int(os.getenv('UPSTREAM_CONNECTIONS', '100')),
+        timeout=float(os.getenv('UPSTREAM_TIMEOUT', '10')),
+        retries=int(os.getenv('UPSTREAM_RETRIES', '2')),
+        hedge=os.getenv('UPSTREAM_HEDGE', '') != '',
+    )
+    # each worker has its own share of the rate limit
+    workers = max(1, int(os.getenv('WORKERS', '1')))
+    ratelimit.configure(
+        rate=float(os.getenv('UPSTREAM_RATE', '0')) / workers,
+        burst=max(1, int(os.getenv('UPSTREAM_BURST', '10')) // workers),
+        max_waiting=int(os.getenv('UPSTREAM_QUEUE', '100')),
+    )
+    configure_cache(
+        max_entries=int(os.getenv('CACHE_SIZE', '1024')),
+        ttl=float(os.getenv('CACHE_TTL', '300')),
+        stale_ttl=float(os.getenv('CACHE_STALE_TTL', '3600')),
+    )
+    configure_negative_cache(
+        max_entries=int(os.getenv('NEGATIVE_CACHE_SIZE', '1024')),
+        ttl=float(os.getenv('NEGATIVE_CACHE_TTL', '60')),
+    )
+    if os.getenv('STORE_PATH'):
+        store.configure(
+            os.getenv('STORE_PATH'),
+            max_age=float(os.getenv('STORE_MAX_AGE', '300')),
+            offline=os.getenv('OFFLINE', '') != '',
+        )
+    configure_connections(
+        max_connections=int(os.getenv('MAX_CONNECTIONS', '1000')),
+        overflow=os.getenv('CONNECTION_OVERFLOW', 'queue'),
+        read_timeout=float(os.getenv('READ_TIMEOUT', '10')),
+    )
+    configure_request_timeout(
+        timeout=float(os.getenv('REQUEST_TIMEOUT', '5')),
+    )
+    configure_render_cache(
+        max_entries=int(os.getenv('RENDER_CACHE_SIZE', '1024')),
+    )
+    markup.configure_text_cache(
+        max_entries=int(os.getenv('TEXT_CACHE_SIZE', '1024')),
+    )
+    # by default, the workers share the CPUs between their pools
+    text_processes = max(1, (os.cpu_count() or 1) // workers)
+    markup.configure_text_processes(
+        processes=int(os.getenv('TEXT_PROCESSES', str(text_processes))),
+        threshold=int(os.getenv('TEXT_PROCESS_THRESHOLD', '65536')),
+    )
+    search_index.configure(
+        max_documents=int(os.getenv('SEARCH_INDEX_SIZE', '100000')),
+    )
+    prefetch.configure(
+        depth=int(os.getenv('PREFETCH_DEPTH', '0')),
+        fanout=int(os.getenv('PREFETCH_FANOUT', '10')),
+        concurrency=int(os.getenv('PREFETCH_CONCURRENCY', '4')),
+    )
 
 
 if __name__ == '__main__':
     ip = os.getenv('IP', '127.0.0.1')
     port = int(os.getenv('PORT', '70'))
+    workers = int(os.getenv('WORKERS', '1'))
 
-    run(ip=ip, port=port)
+    if workers > 1:
+        # the store can't be opened before forking, so each worker sets
+        # itself up
+        run_workers(
+            ip=ip, port=port, workers=workers,
+            setup=configure_from_environment)
+    else:
+        configure_from_environment()
+        run(ip=ip, port=port)
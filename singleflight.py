@@ -0,0 +1,41 @@
+import asyncio
+
+
+class SingleFlight:
+    """Coalesce concurrent calls which have the same key.
+
+    While a call for some key is in flight, further calls for that key
+    don't start any new work: they wait for, and get the result (or
+    exception) of, the call already in flight.
+
+    A caller being cancelled doesn't cancel the shared call, as other
+    callers may be waiting on it.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+
+    def __contains__(self, key):
+        return key in self._in_flight
+
+    async def do(self, key, fn, *args):
+        """Return the result of 'await fn(*args)', sharing it with any
+        concurrent call for the same key.
+        """
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args))
+            self._in_flight[key] = task
+
+            def done(task):
+                if self._in_flight.get(key) is task:
+                    del self._in_flight[key]
+                # mark any exception as retrieved, in case every caller
+                # was cancelled
+                if not task.cancelled():
+                    task.exception()
+
+            task.add_done_callback(done)
+
+        return await asyncio.shield(task)